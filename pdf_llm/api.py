@@ -1,23 +1,46 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
+import fcntl
+import hashlib
+import hmac
+import math
+import multiprocessing
 import os
+import random
+import shutil
+import sqlite3
 import tempfile
+import threading
+import time
+from array import array
+from collections import OrderedDict, deque
+from contextlib import closing, contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from dotenv import load_dotenv
 # Updated imports for LangChain
-from langchain_community.document_loaders import PyPDFLoader
 from langchain_openai import OpenAIEmbeddings, ChatOpenAI
 from langchain_community.vectorstores import Chroma
-from langchain_core.runnables import RunnablePassthrough
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.vectorstores import VectorStore
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
 # Updated Pydantic imports
 from pydantic import BaseModel, Field
 import pandas as pd
+import numpy as np
 import uuid
 import re
 import json
 from werkzeug.utils import secure_filename
+from pypdf import PdfReader
+import openai
+import tiktoken
+
+from chroma_clients import close_vectorstore
+from pdf_extract import extract_page_texts
 
 # Create Flask app
 app = Flask(__name__)
@@ -38,8 +61,143 @@ llm = ChatOpenAI(model="gpt-4o-mini", temperature=0, openai_api_key=OPENAI_API_K
 # Configuration
 UPLOAD_FOLDER = 'uploads'
 VECTOR_STORE_DIR = 'vectorstores'
+JOBS_DIR = os.getenv('JOBS_DIR', 'jobs')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(VECTOR_STORE_DIR, exist_ok=True)
+os.makedirs(JOBS_DIR, exist_ok=True)
+
+# Background ingestion: /upload can hand the PDF to a bounded worker pool
+# and return a job id instead of blocking the request on process_pdf
+ASYNC_INGEST = os.getenv('ASYNC_INGEST', 'false').lower() == 'true'
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', 2))
+INGEST_MAX_PENDING = int(os.getenv('INGEST_MAX_PENDING', 8))
+INGEST_STAGES = ['parsing', 'chunking', 'embedding', 'extracting', 'summarizing']
+# Jobs not updated for this long were lost with the worker running them
+INGEST_STALE_SECONDS = int(os.getenv('INGEST_STALE_SECONDS', 3600))
+
+ingest_executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix='ingest')
+ingest_slots = threading.BoundedSemaphore(INGEST_MAX_PENDING)
+
+# Page text is extracted in worker processes, a few pages per task, with a
+# bounded number of tasks ahead of the pages being chunked and embedded
+PDF_EXTRACT_WORKERS = int(os.getenv('PDF_EXTRACT_WORKERS', os.cpu_count() or 1))
+PDF_PAGES_PER_TASK = int(os.getenv('PDF_PAGES_PER_TASK', 8))
+PDF_PARALLEL_MIN_PAGES = int(os.getenv('PDF_PARALLEL_MIN_PAGES', 16))
+PDF_EXTRACT_MAX_PENDING = int(os.getenv('PDF_EXTRACT_MAX_PENDING', 2 * PDF_EXTRACT_WORKERS))
+
+# 'directory' keeps a Chroma store per index; 'shared' keeps every index in
+# one collection, filtered by index, that each worker opens once
+VECTOR_STORE_MODE = os.getenv('VECTOR_STORE_MODE', 'directory').lower()
+SHARED_STORE_DIR = os.getenv('SHARED_STORE_DIR', os.path.join(VECTOR_STORE_DIR, '_shared'))
+SHARED_COLLECTION = 'sessions'
+SHARED_UPSERT_BATCH = 5000
+
+# New per-index stores use 'chroma' or 'numpy'; existing ones keep theirs
+VECTOR_STORE_BACKEND = os.getenv('VECTOR_STORE_BACKEND', 'chroma').lower()
+NUMPY_VECTORS_FILE = 'vectors.npy'
+NUMPY_CHUNKS_FILE = 'chunks.json'
+NUMPY_SCALES_FILE = 'scales.npy'
+NUMPY_SCORE_BLOCK_ROWS = 4096
+
+# New NumPy stores keep vectors as 'none' (float32), 'float16' or 'int8';
+# quantized searches re-score NUMPY_RERANK_FACTOR * k candidates exactly
+VECTOR_QUANTIZATION = os.getenv('VECTOR_QUANTIZATION', 'none').lower()
+NUMPY_RERANK_FACTOR = int(os.getenv('NUMPY_RERANK_FACTOR', 4))
+
+# Questions retrieve RETRIEVAL_K chunks; hybrid search fuses the top
+# HYBRID_CANDIDATES of vector and BM25 search by reciprocal rank
+RETRIEVAL_K = int(os.getenv('RETRIEVAL_K', 4))
+HYBRID_SEARCH_ENABLED = os.getenv('HYBRID_SEARCH_ENABLED', 'true').lower() == 'true'
+HYBRID_CANDIDATES = int(os.getenv('HYBRID_CANDIDATES', 20))
+HYBRID_RRF_K = int(os.getenv('HYBRID_RRF_K', 60))
+BM25_FILE = 'bm25.json'
+
+# Retrieved chunks are packed into at most CONTEXT_MAX_TOKENS prompt tokens
+CONTEXT_MAX_TOKENS = int(os.getenv('CONTEXT_MAX_TOKENS', 3000))
+CONTEXT_MIN_TRIM_TOKENS = 50
+CHUNK_OVERLAP_MIN_CHARS = 20
+
+# Structured responses extract all fields from the question's retrieval
+# ('single'), or each field from its own retrieval, in parallel ('fields')
+STRUCTURED_EXTRACTION = os.getenv('STRUCTURED_EXTRACTION', 'single').lower()
+FIELD_CONTEXT_MAX_TOKENS = int(os.getenv('FIELD_CONTEXT_MAX_TOKENS', 1500))
+
+# Title, year and authors are extracted once at ingest, from the PDF's
+# document info and first pages, and served for structured queries
+METADATA_EXTRACTION_ENABLED = os.getenv('METADATA_EXTRACTION_ENABLED', 'true').lower() == 'true'
+METADATA_FRONT_PAGES = int(os.getenv('METADATA_FRONT_PAGES', 2))
+METADATA_FILE = 'metadata.json'
+FRONT_MATTER_FIELDS = ('paper_title', 'publication_year', 'paper_authors')
+CHUNK_OVERLAP_MAX_CHARS = 400
+
+# Open vector stores are kept per worker so follow-up questions skip the load
+VECTORSTORE_CACHE_MAX_ENTRIES = int(os.getenv('VECTORSTORE_CACHE_MAX_ENTRIES', 32))
+VECTORSTORE_CACHE_MAX_MB = int(os.getenv('VECTORSTORE_CACHE_MAX_MB', 512))
+VECTORSTORE_CACHE_IDLE_SECONDS = int(os.getenv('VECTORSTORE_CACHE_IDLE_SECONDS', 900))
+
+# Answers can be reused for questions that embed close to one already
+# answered. Off by default: ada-002 similarities crowd near 1, so questions
+# differing in one word ("first author", "last author") can clear the threshold
+ANSWER_CACHE_ENABLED = os.getenv('ANSWER_CACHE_ENABLED', 'false').lower() == 'true'
+ANSWER_CACHE_THRESHOLD = float(os.getenv('ANSWER_CACHE_THRESHOLD', 0.97))
+ANSWER_CACHE_TTL_SECONDS = int(os.getenv('ANSWER_CACHE_TTL_SECONDS', 3600))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv('ANSWER_CACHE_MAX_ENTRIES', 1000))
+
+# Embedding batches: sized in tokens, several in flight at once
+EMBEDDING_BATCH_TOKENS = int(os.getenv('EMBEDDING_BATCH_TOKENS', 20000))
+EMBEDDING_MAX_CONCURRENCY = int(os.getenv('EMBEDDING_MAX_CONCURRENCY', 4))
+EMBEDDING_MAX_RETRIES = int(os.getenv('EMBEDDING_MAX_RETRIES', 5))
+EMBEDDING_BACKOFF_BASE = float(os.getenv('EMBEDDING_BACKOFF_BASE', 1.0))
+EMBEDDING_BACKOFF_MAX = float(os.getenv('EMBEDDING_BACKOFF_MAX', 30.0))
+RETRYABLE_EMBEDDING_ERRORS = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError)
+
+# Embeddings are cached on disk by model and chunk content, across sessions
+EMBEDDING_CACHE_ENABLED = os.getenv('EMBEDDING_CACHE_ENABLED', 'true').lower() == 'true'
+EMBEDDING_CACHE_PATH = os.getenv('EMBEDDING_CACHE_PATH', os.path.join(VECTOR_STORE_DIR, '_embedding_cache.sqlite3'))
+
+# Quantized searches are re-scored with the exact vectors from the embedding cache
+if VECTOR_QUANTIZATION not in ('none', 'float16', 'int8'):
+    raise ValueError(f"VECTOR_QUANTIZATION must be 'none', 'float16' or 'int8', not {VECTOR_QUANTIZATION!r}")
+if VECTOR_QUANTIZATION != 'none' and not EMBEDDING_CACHE_ENABLED:
+    raise ValueError("VECTOR_QUANTIZATION requires EMBEDDING_CACHE_ENABLED=true")
+
+# Embedding and partial summary cache entries unused for CACHE_MAX_AGE_SECONDS
+# are pruned by the reaper; 0 keeps them forever
+CACHE_MAX_AGE_SECONDS = int(os.getenv('CACHE_MAX_AGE_SECONDS', 30 * 24 * 3600))
+CACHE_TOUCH_INTERVAL = 24 * 3600
+
+# Sessions are mapped to indexes so identical uploads can share one index
+SESSION_DB_PATH = os.getenv('SESSION_DB_PATH', os.path.join(VECTOR_STORE_DIR, '_sessions.sqlite3'))
+SUMMARY_FILE = 'summary.json'
+DOCUMENTS_FILE = 'documents.json'
+SESSION_LOCK_DIR = os.path.join(VECTOR_STORE_DIR, '_locks')
+SESSION_TOUCH_INTERVAL = int(os.getenv('SESSION_TOUCH_INTERVAL', 60))
+
+# Sessions unused for SESSION_TTL_SECONDS are deleted, then the least recently
+# used until indexes fit in VECTORSTORE_QUOTA_MB; 0 (the default) turns either off
+SESSION_TTL_SECONDS = int(os.getenv('SESSION_TTL_SECONDS', 0))
+VECTORSTORE_QUOTA_MB = int(os.getenv('VECTORSTORE_QUOTA_MB', 0))
+UPLOAD_MAX_AGE_SECONDS = int(os.getenv('UPLOAD_MAX_AGE_SECONDS', 24 * 3600))
+REAPER_INTERVAL_SECONDS = int(os.getenv('REAPER_INTERVAL_SECONDS', 600))
+REAPER_LOCK_PATH = os.path.join(VECTOR_STORE_DIR, '_reaper.lock')
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+
+# Summaries can be generated during upload ('eager'), in the background once
+# indexing finishes ('background'), or on first request ('lazy')
+SUMMARY_MODE = os.getenv('SUMMARY_MODE', 'eager').lower()
+if SUMMARY_MODE not in ('eager', 'background', 'lazy'):
+    raise ValueError(f"SUMMARY_MODE must be 'eager', 'background' or 'lazy', not {SUMMARY_MODE!r}")
+SUMMARY_WORKERS = int(os.getenv('SUMMARY_WORKERS', 2))
+SUMMARY_WAIT_SECONDS = int(os.getenv('SUMMARY_WAIT_SECONDS', 60))
+SUMMARY_STALE_SECONDS = int(os.getenv('SUMMARY_STALE_SECONDS', 600))
+
+summary_executor = ThreadPoolExecutor(max_workers=SUMMARY_WORKERS, thread_name_prefix='summary')
+
+# Summaries map over groups of chunks covering the whole document, then reduce
+SUMMARY_GROUP_TOKENS = int(os.getenv('SUMMARY_GROUP_TOKENS', 6000))
+SUMMARY_MAX_INPUT_TOKENS = int(os.getenv('SUMMARY_MAX_INPUT_TOKENS', 300000))
+SUMMARY_MAX_CONCURRENCY = int(os.getenv('SUMMARY_MAX_CONCURRENCY', 4))
+SUMMARY_CACHE_PATH = os.getenv('SUMMARY_CACHE_PATH', os.path.join(VECTOR_STORE_DIR, '_summary_cache.sqlite3'))
 
 # Define response models
 class AnswerWithSources(BaseModel):
@@ -69,6 +227,41 @@ PROMPT_TEMPLATE = """
     Answer the question based on the above context: {question}
     """
 
+# Questions used to retrieve and extract each field of ExtractedInfoWithSources
+FIELD_QUESTIONS = {
+    'paper_title': "What is the title of the paper?",
+    'paper_summary': "What is the paper about, and what are its main findings?",
+    'publication_year': "In what year was the paper published?",
+    'paper_authors': "Who are the authors of the paper?",
+}
+
+# Define prompt templates for map-reduce summaries
+MAP_SUMMARY_TEMPLATE = """
+    Summarize the following section of a document. Keep its main topics,
+    claims, names, figures and dates. Don't add anything that is not in the text.
+
+    {text}
+    """
+
+REDUCE_SUMMARY_TEMPLATE = """
+    The following is the text of a document, or summaries of its
+    consecutive sections.
+
+    {text}
+
+    ---
+
+    Please provide a concise summary of this document, including its main
+    topics, purpose, and key points.
+    """
+
+# Define prompt template for plain answers
+ANSWER_TEMPLATE = """Answer the question based only on the following context:
+    {context}
+    
+    Question: {question}
+    """
+
 # Helper functions from app.py
 def get_embedding_function(api_key):
     """
@@ -87,11 +280,559 @@ def get_embedding_function(api_key):
     )
     return embeddings
 
-def process_pdf(pdf_path, session_id):
-    """Process a PDF file and create a vector store"""
+def content_id(text):
+    """Return the content-addressed ID of a chunk of text."""
+    return str(uuid.uuid5(uuid.NAMESPACE_DNS, text))
+
+def add_last_used_column(conn, table):
+    """Add the last_used column to a cache table created before it existed, dating existing rows now."""
+    columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if 'last_used' not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN last_used REAL")
+        conn.execute(f"UPDATE {table} SET last_used = ?", (time.time(),))
+
+def prune_cache_table(path, table, cutoff):
+    """
+    Delete the rows of a cache table last used before cutoff and return how
+    many were deleted. The file is vacuumed so the space goes back to the disk.
+    """
+    with closing(sqlite3.connect(path, timeout=30)) as conn:
+        with conn:
+            deleted = conn.execute(f"DELETE FROM {table} WHERE last_used < ?", (cutoff,)).rowcount
+        if deleted:
+            conn.execute("VACUUM")
+    return deleted
+
+class EmbeddingCache:
+    """
+    A persistent cache of embeddings keyed by (model, content ID), shared by
+    every session and worker. Vectors are stored as float32 blobs in SQLite.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "model TEXT NOT NULL, content_id TEXT NOT NULL, vector BLOB NOT NULL, "
+                "last_used REAL, PRIMARY KEY (model, content_id))"
+            )
+            add_last_used_column(conn, 'embeddings')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get_many(self, model, content_ids):
+        """
+        Return a dict of content ID to vector for the IDs that are cached.
+        Hits are re-dated at most once per CACHE_TOUCH_INTERVAL, so most reads
+        do not write.
+        """
+        found = {}
+        stale = []
+        now = time.time()
+        content_ids = list(set(content_ids))
+        with closing(self._connect()) as conn, conn:
+            # Stay well under SQLite's limit on bound parameters
+            for i in range(0, len(content_ids), 500):
+                batch = content_ids[i:i + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = conn.execute(
+                    f"SELECT content_id, vector, last_used FROM embeddings "
+                    f"WHERE model = ? AND content_id IN ({placeholders})",
+                    [model, *batch],
+                )
+                for cid, blob, last_used in rows:
+                    found[cid] = array('f', blob).tolist()
+                    if (last_used or 0) < now - CACHE_TOUCH_INTERVAL:
+                        stale.append(cid)
+            if stale:
+                conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND content_id = ?",
+                    [(now, model, cid) for cid in stale],
+                )
+        return found
+
+    def put_many(self, model, items):
+        """Store (content ID, vector) pairs, keeping any existing entries."""
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO embeddings (model, content_id, vector, last_used) VALUES (?, ?, ?, ?)",
+                [(model, cid, array('f', vector).tobytes(), time.time()) for cid, vector in items],
+            )
+
+    def prune(self, cutoff):
+        """Delete embeddings last used before cutoff."""
+        return prune_cache_table(self.path, 'embeddings', cutoff)
+
+embedding_cache = EmbeddingCache(EMBEDDING_CACHE_PATH) if EMBEDDING_CACHE_ENABLED else None
+
+class BatchedEmbeddings(Embeddings):
+    """
+    Wrap an embeddings model so that documents are embedded in batches bounded
+    by token count, several batches at a time, with rate-limited batches retried
+    using exponential backoff. Timing for each batch is logged.
+
+    If a cache is given, texts already in it are not sent to the model, and
+    newly embedded texts are added to it.
+    """
+
+    def __init__(self, embeddings, batch_tokens=EMBEDDING_BATCH_TOKENS,
+                 max_concurrency=EMBEDDING_MAX_CONCURRENCY, max_retries=EMBEDDING_MAX_RETRIES,
+                 cache=None):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.batch_tokens = batch_tokens
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.encoding = tiktoken.encoding_for_model(embeddings.model)
+
+    def embed_documents(self, texts):
+        """Embed a list of texts, preserving their order."""
+        ids = [content_id(text) for text in texts]
+        vectors = self.cache.get_many(self.embeddings.model, ids) if self.cache else {}
+        
+        # Only texts missing from the cache go to the model, each of them once
+        missing = {}
+        for cid, text in zip(ids, texts):
+            if cid not in vectors:
+                missing.setdefault(cid, text)
+        
+        batches = self.make_batches(list(missing.values()))
+        if batches:
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(batches))) as executor:
+                results = list(executor.map(
+                    lambda args: self._embed_batch(*args, len(batches)),
+                    enumerate(batches),
+                ))
+            
+            embedded = dict(zip(missing, (vector for result in results for vector in result)))
+            if self.cache:
+                self.cache.put_many(self.embeddings.model, embedded.items())
+            vectors.update(embedded)
+            
+            total_tokens = sum(tokens for _, tokens in batches)
+            print(f"Embedded {len(missing)} chunks ({total_tokens} tokens) in {len(batches)} batches "
+                  f"in {time.perf_counter() - start:.2f}s")
+        
+        if self.cache:
+            print(f"Embedding cache: {len(texts) - len(missing)} hits, {len(missing)} misses")
+        
+        return [vectors[cid] for cid in ids]
+
+    def embed_query(self, text):
+        """Embed a single query."""
+        return self.embeddings.embed_query(text)
+
+    def cached_vectors(self, texts):
+        """Return the cached embedding of each text, or None where it is not cached, without calling the model."""
+        if not self.cache:
+            return [None for _ in texts]
+        ids = [content_id(text) for text in texts]
+        vectors = self.cache.get_many(self.embeddings.model, ids)
+        return [vectors.get(cid) for cid in ids]
+
+    def count_tokens(self, text):
+        """Return the number of tokens the model sees for a text."""
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def make_batches(self, texts):
+        """Group texts into (texts, token_count) batches of at most batch_tokens tokens."""
+        batches = []
+        batch, batch_tokens = [], 0
+        for text in texts:
+            tokens = self.count_tokens(text)
+            if batch and batch_tokens + tokens > self.batch_tokens:
+                batches.append((batch, batch_tokens))
+                batch, batch_tokens = [], 0
+            batch.append(text)
+            batch_tokens += tokens
+        if batch:
+            batches.append((batch, batch_tokens))
+        return batches
+
+    def _embed_batch(self, index, batch, total_batches):
+        texts, tokens = batch
+        for attempt in range(self.max_retries + 1):
+            start = time.perf_counter()
+            try:
+                vectors = self.embeddings.embed_documents(texts)
+            except RETRYABLE_EMBEDDING_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = min(EMBEDDING_BACKOFF_MAX, EMBEDDING_BACKOFF_BASE * 2 ** attempt)
+                delay *= random.uniform(0.5, 1.0)
+                print(f"Embedding batch {index + 1}/{total_batches} failed ({type(e).__name__}), "
+                      f"retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            
+            print(f"Embedded batch {index + 1}/{total_batches}: {len(texts)} chunks, {tokens} tokens "
+                  f"in {time.perf_counter() - start:.2f}s (attempt {attempt + 1})")
+            return vectors
+
+def write_json(path, data):
+    """Write JSON to a file atomically, so readers never see a partial file."""
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+def read_json(path):
+    """Read a JSON file, or return None if it is missing or incomplete."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def hash_upload(file):
+    """Return the SHA-256 of an uploaded file, leaving its stream rewound."""
+    digest = hashlib.sha256()
+    for block in iter(lambda: file.stream.read(1024 * 1024), b''):
+        digest.update(block)
+    file.stream.seek(0)
+    return digest.hexdigest()
+
+class SessionRegistry:
+    """
+    Maps sessions to the index directory under VECTOR_STORE_DIR that serves
+    them, and uploaded documents (by SHA-256) to the index built from them.
+
+    Several sessions can share one index; the index is referenced by every
+    session row that names it. Sessions created before the registry existed
+    have no row and are served from the directory named after the session.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "session_id TEXT PRIMARY KEY, index_name TEXT NOT NULL, "
+                "document_hash TEXT, created_at REAL NOT NULL)"
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(sessions)")}
+            if 'last_access' not in columns:
+                conn.execute("ALTER TABLE sessions ADD COLUMN last_access REAL")
+            conn.execute("CREATE INDEX IF NOT EXISTS sessions_index_name ON sessions (index_name)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS documents ("
+                "document_hash TEXT PRIMARY KEY, index_name TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def add_session(self, session_id, index_name, document_hash=None):
+        """Record that a session is served by an index."""
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (session_id, index_name, document_hash, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (session_id, index_name, document_hash, now, now),
+            )
+
+    def touch(self, session_id):
+        """
+        Record that a session has just been used. A session created before the
+        registry existed gets a row here, served by the directory named after it,
+        so its use is tracked from then on.
+        """
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            updated = conn.execute(
+                "UPDATE sessions SET last_access = ? WHERE session_id = ?", (now, session_id)
+            ).rowcount
+            if not updated and is_index_name(session_id) and os.path.isdir(os.path.join(VECTOR_STORE_DIR, session_id)):
+                conn.execute(
+                    "INSERT OR IGNORE INTO sessions (session_id, index_name, created_at, last_access) "
+                    "VALUES (?, ?, ?, ?)",
+                    (session_id, session_id, now, now),
+                )
+
+    def remove_sessions(self, session_ids):
+        """Delete sessions, returning the names of the indexes they used."""
+        with closing(self._connect()) as conn, conn:
+            index_names = set()
+            for session_id in session_ids:
+                row = conn.execute(
+                    "SELECT index_name FROM sessions WHERE session_id = ?", (session_id,)
+                ).fetchone()
+                if row:
+                    index_names.add(row[0])
+                conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+        return index_names
+
+    def expired_sessions(self, cutoff):
+        """Return the sessions last used before cutoff."""
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT session_id FROM sessions WHERE COALESCE(last_access, created_at) < ?", (cutoff,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def sessions(self, index_name=None):
+        """Return (session_id, index_name, created_at, last_access) rows, for one index or all."""
+        query = "SELECT session_id, index_name, created_at, COALESCE(last_access, created_at) FROM sessions"
+        with closing(self._connect()) as conn:
+            if index_name is None:
+                return conn.execute(query).fetchall()
+            return conn.execute(query + " WHERE index_name = ?", (index_name,)).fetchall()
+
+    def set_index(self, session_id, index_name):
+        """Point an existing session at a different index."""
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "UPDATE sessions SET index_name = ? WHERE session_id = ?", (index_name, session_id)
+            )
+
+    def has_session(self, session_id):
+        """Return whether a session has been registered."""
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT 1 FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return row is not None
+
+    def index_name(self, session_id):
+        """Return the name of the index that serves a session."""
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT index_name FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+        return row[0] if row else session_id
+
+    def ref_count(self, index_name):
+        """Return the number of sessions served by an index."""
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT COUNT(*) FROM sessions WHERE index_name = ?", (index_name,)
+            ).fetchone()
+        return row[0]
+
+    def add_document(self, document_hash, index_name):
+        """Record the index built from a document, keeping any earlier one."""
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO documents (document_hash, index_name, created_at) VALUES (?, ?, ?)",
+                (document_hash, index_name, time.time()),
+            )
+
+    def remove_documents(self, index_name):
+        """Stop offering an index for de-duplication, e.g. once it holds more than one document."""
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM documents WHERE index_name = ?", (index_name,))
+
+    def find_document(self, document_hash):
+        """
+        Return the name of a complete index built from a document, or None.
+        Entries whose index has since disappeared are dropped.
+        """
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT index_name FROM documents WHERE document_hash = ?", (document_hash,)
+            ).fetchone()
+        if row is None:
+            return None
+        
+        if not os.path.isdir(os.path.join(VECTOR_STORE_DIR, row[0])):
+            with closing(self._connect()) as conn, conn:
+                conn.execute("DELETE FROM documents WHERE document_hash = ?", (document_hash,))
+            return None
+        
+        return row[0]
+
+session_registry = SessionRegistry(SESSION_DB_PATH)
+
+def is_session_id(value):
+    """Return whether a value is a session ID: a UUID in canonical form."""
+    try:
+        return isinstance(value, str) and str(uuid.UUID(value)) == value
+    except ValueError:
+        return False
+
+def is_index_name(name):
+    """
+    Return whether a name can only refer to an index: an immediate child of
+    VECTOR_STORE_DIR that is not prefixed with '_'.
+    """
+    root = os.path.realpath(VECTOR_STORE_DIR)
+    path = os.path.realpath(os.path.join(root, name))
+    return bool(name) and not name.startswith('_') and os.path.dirname(path) == root and os.path.basename(path) == name
+
+def session_index_dir(session_id):
+    """Return the directory of the index that serves a session."""
+    return os.path.join(VECTOR_STORE_DIR, session_registry.index_name(session_id))
+
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive flock on a lock file, across threads and workers."""
+    with open(path, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+def session_lock(session_id):
+    """
+    Hold an exclusive lock on writing to a session's index, across workers,
+    so documents added at the same time are not lost to each other's rewrites.
+    """
+    os.makedirs(SESSION_LOCK_DIR, exist_ok=True)
+    return file_lock(os.path.join(SESSION_LOCK_DIR, f'{session_id}.lock'))
+
+def remove_session_locks(session_ids):
+    """Delete the lock files of sessions that no longer exist."""
+    for session_id in session_ids:
+        if not is_session_id(session_id):
+            continue
+        try:
+            os.remove(os.path.join(SESSION_LOCK_DIR, f'{session_id}.lock'))
+        except FileNotFoundError:
+            pass
+
+def writable_index_dir(session_id):
+    """
+    Return the directory of an index that a session can add documents to.
+
+    An index shared with other sessions is copied first and the session moved
+    to the copy, so the others keep seeing the documents they uploaded. An
+    index the session owns alone is changed in place, and is no longer offered
+    for de-duplication since it will hold more than the one document.
+    """
+    index_name = session_registry.index_name(session_id)
+    if not is_session_id(session_id) or not is_index_name(index_name):
+        raise ValueError(f"Invalid session ID: {session_id!r}")
+    
+    if session_registry.ref_count(index_name) > 1:
+        new_index_name = str(uuid.uuid4())
+        shutil.copytree(
+            os.path.join(VECTOR_STORE_DIR, index_name),
+            os.path.join(VECTOR_STORE_DIR, new_index_name),
+        )
+        if VECTOR_STORE_MODE == 'shared':
+            SharedIndex(get_shared_store(), index_name).copy_to(new_index_name)
+        session_registry.set_index(session_id, new_index_name)
+        return os.path.join(VECTOR_STORE_DIR, new_index_name)
+    
+    session_registry.remove_documents(index_name)
+    if not session_registry.has_session(session_id):
+        session_registry.add_session(session_id, index_name)
+    return os.path.join(VECTOR_STORE_DIR, index_name)
+
+def read_documents(index_dir):
+    """Return the list of documents in an index, oldest first."""
+    return (read_json(os.path.join(index_dir, DOCUMENTS_FILE)) or {}).get('documents', [])
+
+def index_generation(index_dir):
+    """Return a value that changes whenever documents are added to an index."""
+    try:
+        return os.stat(os.path.join(index_dir, DOCUMENTS_FILE)).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+pdf_extract_pool = None
+pdf_extract_pool_lock = threading.Lock()
+
+def get_pdf_extract_pool():
+    """Return the worker process pool for page extraction, starting it if needed."""
+    global pdf_extract_pool
+    with pdf_extract_pool_lock:
+        if pdf_extract_pool is None:
+            # This process already runs threads, which a plain fork could copy
+            # mid-lock; workers are forked from a single-threaded fork server
+            pdf_extract_pool = ProcessPoolExecutor(
+                max_workers=PDF_EXTRACT_WORKERS, mp_context=multiprocessing.get_context('forkserver')
+            )
+        return pdf_extract_pool
+
+def reset_pdf_extract_pool(pool):
+    """Discard a broken extraction pool, so the next upload starts a new one."""
+    global pdf_extract_pool
+    with pdf_extract_pool_lock:
+        if pdf_extract_pool is pool:
+            pdf_extract_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def iter_pdf_pages(pdf_path):
+    """
+    Yield a Document for each page of a PDF, in page order, with the same
+    metadata as PyPDFLoader. Large PDFs are extracted in parallel by the worker
+    pool, and pages are yielded as soon as they and every page before them are
+    ready, so callers can start work while later pages are still extracting.
+    """
+    page_count = len(PdfReader(pdf_path).pages)
+    
+    if PDF_EXTRACT_WORKERS > 1 and page_count >= PDF_PARALLEL_MIN_PAGES:
+        texts = iter_parallel_page_texts(pdf_path, page_count)
+    else:
+        reader = PdfReader(pdf_path)
+        texts = (page.extract_text() for page in reader.pages)
+    
+    for page_number, text in enumerate(texts):
+        yield Document(page_content=text, metadata={'source': pdf_path, 'page': page_number})
+
+def iter_parallel_page_texts(pdf_path, page_count):
+    """
+    Yield page texts in order from the extraction pool, keeping at most
+    PDF_EXTRACT_MAX_PENDING tasks ahead of the consumer so extracted text
+    does not pile up in memory while embedding catches up.
+
+    If a worker dies, e.g. killed for using too much memory, the pool is
+    replaced for later uploads and the remaining pages are extracted here.
+    """
+    pool = get_pdf_extract_pool()
+    pending = deque()
+    next_page = 0
+    
+    try:
+        try:
+            for start in range(0, page_count, PDF_PAGES_PER_TASK):
+                end = min(start + PDF_PAGES_PER_TASK, page_count)
+                pending.append(pool.submit(extract_page_texts, pdf_path, start, end))
+                if len(pending) >= PDF_EXTRACT_MAX_PENDING:
+                    texts = pending.popleft().result()
+                    next_page += len(texts)
+                    yield from texts
+            
+            while pending:
+                texts = pending.popleft().result()
+                next_page += len(texts)
+                yield from texts
+        except BrokenProcessPool:
+            print(f"PDF extraction pool failed at page {next_page} of {pdf_path}, extracting the rest serially")
+            pending.clear()
+            reset_pdf_extract_pool(pool)
+            reader = PdfReader(pdf_path)
+            for page_number in range(next_page, page_count):
+                yield reader.pages[page_number].extract_text()
+    finally:
+        for future in pending:
+            future.cancel()
+
+def iter_chunks(pages, text_splitter, start=0):
+    """
+    Yield chunks page by page as pages arrive. Splitting each page on its own
+    gives the same chunks as split_documents on the whole list, since the
+    splitter never joins text across documents. Each chunk's position in the
+    index, counting from start, is recorded in its 'chunk' metadata.
+    """
+    chunk_index = start
+    for page in pages:
+        for chunk in text_splitter.split_documents([page]):
+            chunk.metadata['chunk'] = chunk_index
+            chunk_index += 1
+            yield chunk
+
+def index_pdf(pdf_path, persist_dir, document_id, filename, report):
+    """
+    Add a PDF's chunks to the vector store in persist_dir, creating it if
+    needed, and record the document in the index's document list.
+    """
     # Load PDF
-    loader = PyPDFLoader(pdf_path)
-    documents = loader.load()
+    report('parsing')
+    pages = iter_pdf_pages(pdf_path)
     
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=1500, 
@@ -102,140 +843,1690 @@ def process_pdf(pdf_path, session_id):
             "\u3001", "\uff0e", "\u3002", "",
         ]
     )
-    chunks = text_splitter.split_documents(documents)
     
     # Get embedding function
     embedding_function = get_embedding_function(OPENAI_API_KEY)
     
+    # Chunks stream from the pages as they are extracted, numbered after any
+    # already in the index and tagged with the document they came from
+    documents = read_documents(persist_dir)
+    first_chunk = sum(document['chunks'] for document in documents)
+    
+    def chunks():
+        report('chunking')
+        for chunk in iter_chunks(pages, text_splitter, start=first_chunk):
+            chunk.metadata.update(document_id=document_id, filename=filename)
+            yield chunk
+    
     # Create vector store using the separate function
+    vectorstore, chunk_count = create_vectorstore(chunks(), embedding_function, persist_dir, progress=report)
+    
+    documents.append({
+        'document_id': document_id,
+        'filename': filename,
+        'chunks': chunk_count,
+        'added_at': time.time(),
+    })
+    write_json(os.path.join(persist_dir, DOCUMENTS_FILE), {'documents': documents})
+    
+    if METADATA_EXTRACTION_ENABLED:
+        # The front matter is read now, while the PDF is still on disk
+        try:
+            front_matter = read_front_matter(pdf_path)
+        except Exception as e:
+            front_matter = None
+            print(f"Error reading front matter of {filename}: {e}")
+        
+        if front_matter is not None and SUMMARY_MODE == 'eager':
+            report('extracting')
+            extract_document_metadata(front_matter, vectorstore, persist_dir, document_id, filename)
+        elif front_matter is not None:
+            # Like the summary, the LLM calls are kept out of the upload
+            summary_executor.submit(
+                extract_document_metadata, front_matter, vectorstore, persist_dir, document_id, filename
+            )
+    
+    return vectorstore
+
+def refresh_summary(persist_dir, vectorstore, report):
+    """Produce the summary for an index according to SUMMARY_MODE, returning it if eager."""
+    if SUMMARY_MODE == 'eager':
+        report('summarizing')
+        return build_summary(persist_dir, vectorstore)
+    
+    if SUMMARY_MODE == 'background':
+        schedule_summary(persist_dir, vectorstore)
+    elif os.path.exists(os.path.join(persist_dir, SUMMARY_FILE)):
+        # Lazy summaries are regenerated on the next request
+        os.remove(os.path.join(persist_dir, SUMMARY_FILE))
+    return None
+
+def process_pdf(pdf_path, session_id, progress=None, document_hash=None, filename=None):
+    """
+    Process a PDF file and create a vector store.
+
+    If given, progress(stage) is called as each of INGEST_STAGES starts. The
+    session is registered as the index for document_hash once it is built.
+
+    The summary is only returned when SUMMARY_MODE is 'eager'; otherwise it is
+    None and the summary is produced later, see get_summary.
+    """
+    report = progress or (lambda stage: None)
+    
+    document_id = document_hash or uuid.uuid4().hex
     persist_dir = os.path.join(VECTOR_STORE_DIR, session_id)
-    vectorstore = create_vectorstore(chunks, embedding_function, persist_dir)
+    # Documents may be added to the session before this finishes
+    with session_lock(session_id):
+        try:
+            vectorstore = index_pdf(pdf_path, persist_dir, document_id, filename or os.path.basename(pdf_path), report)
+        except Exception:
+            # A partial index would otherwise be served under the session ID
+            delete_index(session_id)
+            raise
+        
+        # Register the session, and its index as the one for this document
+        session_registry.add_session(session_id, session_id, document_hash)
+        if document_hash:
+            session_registry.add_document(document_hash, session_id)
     
     # Generate PDF summary
-    summary = generate_pdf_summary(vectorstore)
+    summary = refresh_summary(persist_dir, vectorstore, report)
     
     return persist_dir, summary
 
+def add_pdf_to_session(pdf_path, session_id, progress=None, document_hash=None, filename=None):
+    """
+    Add a PDF to an existing session's index. Only chunks that are not already
+    in the index are embedded and added, and a document the session already
+    has is skipped entirely.
+
+    Returns (document_id, added), where added is False if it was skipped.
+    """
+    report = progress or (lambda stage: None)
+    
+    document_id = document_hash or uuid.uuid4().hex
+    with session_lock(session_id):
+        if any(document['document_id'] == document_id for document in read_documents(session_index_dir(session_id))):
+            return document_id, False
+        
+        persist_dir = writable_index_dir(session_id)
+        index_name = os.path.basename(persist_dir)
+        vectorstore = index_pdf(pdf_path, persist_dir, document_id, filename or os.path.basename(pdf_path), report)
+        
+        vectorstore_cache.invalidate(index_name)
+        if answer_cache:
+            answer_cache.invalidate(index_name)
+    
+    # The summary now has to cover every document in the session
+    refresh_summary(persist_dir, vectorstore, report)
+    
+    return document_id, True
+
+def get_llm_encoding():
+    """Return the tiktoken encoding for the chat model."""
+    try:
+        return tiktoken.encoding_for_model(llm.model_name)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+llm_encoding = get_llm_encoding()
+
+def count_llm_tokens(text):
+    """Return the number of tokens the chat model sees for a text."""
+    return len(llm_encoding.encode(text, disallowed_special=()))
+
+class PartialSummaryCache:
+    """Partial summaries of chunk groups, keyed by a hash of the group's text."""
+
+    def __init__(self, path):
+        self.path = path
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS partial_summaries ("
+                "group_hash TEXT PRIMARY KEY, summary TEXT NOT NULL, last_used REAL)"
+            )
+            add_last_used_column(conn, 'partial_summaries')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get_many(self, group_hashes):
+        """Return a dict of group hash to summary for the groups that are cached."""
+        found = {}
+        stale = []
+        now = time.time()
+        group_hashes = list(set(group_hashes))
+        with closing(self._connect()) as conn, conn:
+            for i in range(0, len(group_hashes), 500):
+                batch = group_hashes[i:i + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = conn.execute(
+                    f"SELECT group_hash, summary, last_used FROM partial_summaries "
+                    f"WHERE group_hash IN ({placeholders})",
+                    batch,
+                )
+                for group_hash, summary, last_used in rows:
+                    found[group_hash] = summary
+                    if (last_used or 0) < now - CACHE_TOUCH_INTERVAL:
+                        stale.append(group_hash)
+            if stale:
+                conn.executemany(
+                    "UPDATE partial_summaries SET last_used = ? WHERE group_hash = ?",
+                    [(now, group_hash) for group_hash in stale],
+                )
+        return found
+
+    def put_many(self, items):
+        """Store (group hash, summary) pairs."""
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO partial_summaries (group_hash, summary, last_used) VALUES (?, ?, ?)",
+                [(group_hash, summary, time.time()) for group_hash, summary in items],
+            )
+
+    def prune(self, cutoff):
+        """Delete partial summaries last used before cutoff."""
+        return prune_cache_table(self.path, 'partial_summaries', cutoff)
+
+partial_summary_cache = PartialSummaryCache(SUMMARY_CACHE_PATH)
+
+def group_texts(texts, max_tokens):
+    """Group consecutive texts into (text, token_count) groups of about max_tokens tokens."""
+    groups = []
+    group, group_tokens = [], 0
+    for text in texts:
+        tokens = count_llm_tokens(text)
+        if group and group_tokens + tokens > max_tokens:
+            groups.append(("\n\n".join(group), group_tokens))
+            group, group_tokens = [], 0
+        group.append(text)
+        group_tokens += tokens
+    if group:
+        groups.append(("\n\n".join(group), group_tokens))
+    return groups
+
+def limit_groups(groups, max_tokens):
+    """
+    Keep an evenly spaced selection of groups, in document order, whose
+    tokens add up to no more than max_tokens.
+    """
+    total = sum(tokens for _, tokens in groups)
+    if total <= max_tokens:
+        return groups
+    
+    keep = max(1, int(len(groups) * max_tokens / total))
+    step = len(groups) / keep
+    return [groups[int(i * step)] for i in range(keep)]
+
+def summarize_groups(groups):
+    """Summarize each group, in parallel, reusing cached partial summaries."""
+    hashes = [
+        hashlib.sha256(f"{llm.model_name}\n{MAP_SUMMARY_TEMPLATE}\n{text}".encode()).hexdigest()
+        for text, _ in groups
+    ]
+    summaries = partial_summary_cache.get_many(hashes)
+    
+    missing = [(group_hash, text) for group_hash, (text, _) in zip(hashes, groups) if group_hash not in summaries]
+    if missing:
+        chain = ChatPromptTemplate.from_template(MAP_SUMMARY_TEMPLATE) | llm
+        responses = chain.batch(
+            [{"text": text} for _, text in missing],
+            config={"max_concurrency": SUMMARY_MAX_CONCURRENCY},
+        )
+        new_summaries = {group_hash: response.content for (group_hash, _), response in zip(missing, responses)}
+        partial_summary_cache.put_many(new_summaries.items())
+        summaries.update(new_summaries)
+    
+    print(f"Summarized {len(groups)} chunk groups ({len(groups) - len(missing)} cached)")
+    return [summaries[group_hash] for group_hash in hashes]
+
+def get_document_chunks(vectorstore):
+    """
+    Return the text of every chunk in a vector store, in document order, and
+    documents in the order they were added. Chunks are numbered across the
+    whole index; older indexes without chunk numbers fall back to page order.
+    """
+    data = vectorstore.get(include=["documents", "metadatas"])
+    chunks = sorted(
+        zip(data["documents"], data["metadatas"]),
+        key=lambda item: ((item[1] or {}).get("chunk", 0), (item[1] or {}).get("page", 0)),
+    )
+    return [text for text, _ in chunks]
+
 def generate_pdf_summary(vectorstore):
-    """Generate a summary of the PDF content"""
+    """
+    Generate a summary of the PDF content covering the whole document.
+
+    Chunks are grouped into sections of SUMMARY_GROUP_TOKENS tokens, which are
+    summarized in parallel (map). The section summaries are then grouped and
+    summarized again until they fit in one prompt for the final summary
+    (reduce). Documents longer than SUMMARY_MAX_INPUT_TOKENS are summarized
+    from an evenly spaced selection of sections.
+    """
     try:
-        # Create a retrieval chain
-        chain = create_retrieval_chain(vectorstore)
+        groups = group_texts(get_document_chunks(vectorstore), SUMMARY_GROUP_TOKENS)
+        groups = limit_groups(groups, SUMMARY_MAX_INPUT_TOKENS)
+        
+        # Collapse section summaries until they fit in a single prompt
+        while len(groups) > 1:
+            collapsed = group_texts(summarize_groups(groups), SUMMARY_GROUP_TOKENS)
+            if len(collapsed) >= len(groups):
+                # The summaries are no shorter than their sections, so stop here
+                collapsed = [("\n\n".join(text for text, _ in collapsed), sum(tokens for _, tokens in collapsed))]
+            groups = collapsed
         
-        # Ask for a summary
-        summary_prompt = "Please provide a concise summary of this document, including its main topics, purpose, and key points."
-        response = chain.invoke(summary_prompt)
+        chain = ChatPromptTemplate.from_template(REDUCE_SUMMARY_TEMPLATE) | llm
+        response = chain.invoke({"text": groups[0][0] if groups else ""})
         
         return response.content
     except Exception as e:
         print(f"Error generating summary: {e}")
         return "Unable to generate summary. The document has been processed and you can ask specific questions about it."
 
-def create_vectorstore(chunks, embedding_function, persist_dir):
+def read_summary(index_dir):
     """
-    Create a vector store from a list of text chunks.
+    Return an index's summary record: {'status': 'pending' or 'ready',
+    'summary': ..., 'updated_at': ...}, or None if none has been started.
+    Pending records that have not finished in SUMMARY_STALE_SECONDS are
+    treated as abandoned, e.g. by a worker that was restarted.
     """
-    # Create a list of unique IDs for each doc based on content
-    ids = [str(uuid.uuid5(uuid.NAMESPACE_DNS, doc.page_content)) for doc in chunks]
+    record = read_json(os.path.join(index_dir, SUMMARY_FILE))
+    if record and record['status'] == 'pending' and time.time() - record['updated_at'] > SUMMARY_STALE_SECONDS:
+        return None
+    return record
+
+def write_summary(index_dir, status, summary=None):
+    """Store an index's summary record next to its vector store."""
+    write_json(os.path.join(index_dir, SUMMARY_FILE), {
+        'status': status,
+        'summary': summary,
+        'updated_at': time.time(),
+    })
+
+def build_summary(index_dir, vectorstore=None):
+    """Generate and store the summary for an index, returning it."""
+    if vectorstore is None:
+        vectorstore = open_index(index_dir)
     
-    unique_ids = set()
-    unique_chunks = []
+    write_summary(index_dir, 'pending')
+    summary = generate_pdf_summary(vectorstore)
+    write_summary(index_dir, 'ready', summary)
+    return summary
+
+def schedule_summary(index_dir, vectorstore=None):
+    """Generate the summary for an index in the background."""
+    write_summary(index_dir, 'pending')
+    summary_executor.submit(build_summary, index_dir, vectorstore)
+
+def get_summary(index_dir, wait_seconds):
+    """
+    Return an index's summary record, waiting up to wait_seconds for one that
+    is being generated. If none has been started it is scheduled now, so a
+    long document does not hold the request past the server's timeout.
+    """
+    record = read_summary(index_dir)
+    if record is None:
+        schedule_summary(index_dir)
+        record = read_summary(index_dir)
     
-    for chunk, id in zip(chunks, ids):
-        if id not in unique_ids:
-            unique_ids.add(id)
-            unique_chunks.append(chunk)
+    deadline = time.time() + wait_seconds
+    while record['status'] == 'pending' and time.time() < deadline:
+        time.sleep(0.5)
+        record = read_summary(index_dir) or record
     
-    # Create a vector store from the unique chunks and ids
-    vectorstore = Chroma.from_documents(
-        documents=unique_chunks, 
-        embedding=embedding_function, 
-        ids=list(unique_ids), 
-        persist_directory=persist_dir
-    )
+    return record
+
+def create_vectorstore(chunks, embedding_function, persist_dir, progress=None):
+    """
+    Create a vector store from an iterable of text chunks, or add the chunks
+    to the one already in persist_dir.
+
+    Chunks are consumed lazily and embedded a window at a time, each window
+    sized to keep every concurrent embedding batch full, so only one window of
+    chunks and vectors is held in memory however long the document is. Chunks
+    already in the store are skipped.
+
+    Returns the vector store and the number of chunks added.
+    """
+    report = progress or (lambda stage: None)
     
-    return vectorstore
+    # The document list is written here even if the PDF yields no chunks, in
+    # which case the NumPy store never creates it
+    os.makedirs(persist_dir, exist_ok=True)
+    
+    if VECTOR_STORE_MODE == 'shared':
+        # The index directory only holds the summary and document list
+        vectorstore = SharedIndex(get_shared_store(), os.path.basename(persist_dir))
+        embeddings = vectorstore.embeddings
+    else:
+        embeddings = BatchedEmbeddings(embedding_function, cache=embedding_cache)
+        if is_numpy_index(persist_dir) or (
+            VECTOR_STORE_BACKEND == 'numpy' and not os.path.exists(os.path.join(persist_dir, 'chroma.sqlite3'))
+        ):
+            vectorstore = NumpyVectorStore(embeddings, persist_dir)
+        else:
+            vectorstore = Chroma(embedding_function=embeddings, persist_directory=persist_dir)
+    window_tokens = embeddings.batch_tokens * embeddings.max_concurrency
+    
+    # Chunks are also added to the index's BM25 index for hybrid search
+    bm25 = BM25Index.load(persist_dir)
+    
+    # Only the IDs of chunks already added are kept, to skip duplicates
+    seen_ids = set()
+    window, window_ids, tokens = [], [], 0
+    added = 0
+    
+    def add_window():
+        existing = set(vectorstore.get(ids=window_ids, include=[])['ids'])
+        new_chunks = [(chunk, id) for chunk, id in zip(window, window_ids) if id not in existing]
+        if new_chunks:
+            report('embedding')
+            vectorstore.add_documents([chunk for chunk, _ in new_chunks], ids=[id for _, id in new_chunks])
+            bm25.add(new_chunks)
+        return len(new_chunks)
+    
+    for chunk in chunks:
+        id = chunk_id(chunk)
+        if id in seen_ids:
+            continue
+        seen_ids.add(id)
+        
+        window.append(chunk)
+        window_ids.append(id)
+        tokens += embeddings.count_tokens(chunk.page_content)
+        
+        if tokens >= window_tokens:
+            added += add_window()
+            window, window_ids, tokens = [], [], 0
+    
+    if window:
+        added += add_window()
+    
+    if added:
+        bm25.save(persist_dir)
+    
+    return vectorstore, added
+
+def chunk_id(chunk):
+    """Return the ID of a chunk, based on its document and content."""
+    return content_id(f"{chunk.metadata.get('document_id', '')}\n{chunk.page_content}")
 
 def load_vectorstore(persist_dir):
     """
-    Load a vector store from a directory.
+    Load a vector store from a directory, with whichever backend created it.
     """
+    if is_numpy_index(persist_dir):
+        # Quantized stores re-score candidates with vectors from the embedding cache
+        embeddings = BatchedEmbeddings(get_embedding_function(OPENAI_API_KEY), cache=embedding_cache)
+        return NumpyVectorStore(embeddings, persist_dir)
+    
     vectorstore = Chroma(
         embedding_function=get_embedding_function(OPENAI_API_KEY),
         persist_directory=persist_dir
     )
     return vectorstore
 
-def format_docs(docs):
+def is_numpy_index(persist_dir):
+    """Return whether a directory holds a NumpyVectorStore."""
+    return os.path.exists(os.path.join(persist_dir, NUMPY_VECTORS_FILE))
+
+def metadata_matches(metadata, filter):
     """
-    Format a list of Document objects into a single string.
+    Return whether chunk metadata matches a Chroma-style filter: equality,
+    $eq, $ne, $in, $nin, $gt, $gte, $lt, $lte, and $and / $or of filters.
     """
-    return "\n\n".join(doc.page_content for doc in docs)
+    for key, condition in filter.items():
+        if key == '$and':
+            if not all(metadata_matches(metadata, part) for part in condition):
+                return False
+        elif key == '$or':
+            if not any(metadata_matches(metadata, part) for part in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = metadata.get(key)
+            for operator, operand in condition.items():
+                if not METADATA_OPERATORS[operator](value, operand):
+                    return False
+        elif metadata.get(key) != condition:
+            return False
+    return True
 
-def create_retrieval_chain(vectorstore):
-    """Create a retrieval chain from a vector store"""
-    # Create a retriever
-    retriever = vectorstore.as_retriever()
-    
-    # Define a prompt template
-    template = """Answer the question based only on the following context:
-    {context}
-    
-    Question: {question}
-    """
-    prompt = ChatPromptTemplate.from_template(template)
-    
-    # Create the chain
-    chain = (
-        {"context": retriever, "question": RunnablePassthrough()}
-        | prompt
-        | llm
-    )
-    
-    return chain
+METADATA_OPERATORS = {
+    '$eq': lambda value, operand: value == operand,
+    '$ne': lambda value, operand: value != operand,
+    '$in': lambda value, operand: value in operand,
+    '$nin': lambda value, operand: value not in operand,
+    '$gt': lambda value, operand: value is not None and value > operand,
+    '$gte': lambda value, operand: value is not None and value >= operand,
+    '$lt': lambda value, operand: value is not None and value < operand,
+    '$lte': lambda value, operand: value is not None and value <= operand,
+}
 
-def query_document(vectorstore, query):
+def quantize(vectors, quantization):
     """
-    Query a vector store with a question and return a structured response.
+    Return (stored matrix, per-row scales or None) for normalized float32
+    vectors. 'int8' scales each row to [-127, 127], 'float16' halves the
+    precision, and 'none' keeps float32.
     """
-    retriever = vectorstore.as_retriever(search_type="similarity")
-    prompt_template = ChatPromptTemplate.from_template(PROMPT_TEMPLATE)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if quantization == 'int8':
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1.0
+        return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+    if quantization == 'float16':
+        return vectors.astype(np.float16), None
+    return vectors, None
 
-    rag_chain = (
-        {"context": retriever | format_docs, "question": RunnablePassthrough()}
-        | prompt_template
-        | llm.with_structured_output(ExtractedInfoWithSources)
-    )
+def dequantize(matrix, scales=None):
+    """Return the float32 vectors approximated by a stored matrix."""
+    vectors = np.asarray(matrix, dtype=np.float32)
+    return vectors * scales[:, None] if scales is not None else vectors
 
-    structured_response = rag_chain.invoke(query)
-    
-    # Convert to dictionary for easier JSON serialization
-    return structured_response.dict()
+def stored_quantization(matrix):
+    """Return the quantization a stored matrix was saved with."""
+    return {'int8': 'int8', 'float16': 'float16'}.get(matrix.dtype.name, 'none')
 
-# API Routes
-@app.route('/upload', methods=['POST'])
-def upload_pdf():
-    """Upload a PDF file and process it"""
-    if 'file' not in request.files:
-        return jsonify({'error': 'No file part'}), 400
-    
-    file = request.files['file']
-    
-    if file.filename == '':
-        return jsonify({'error': 'No selected file'}), 400
-    
-    if file and file.filename.endswith('.pdf'):
-        # Generate a session ID
-        session_id = str(uuid.uuid4())
+class NumpyVectorStore(VectorStore):
+    """
+    A vector store kept as one matrix of normalized embeddings and searched by
+    brute force. For the few hundred chunks of a PDF a single matrix product
+    is faster than an HNSW index, and opening the store is a memory map rather
+    than a database connection.
+
+    Vectors are saved in NUMPY_VECTORS_FILE and chunk IDs, texts and metadata
+    in NUMPY_CHUNKS_FILE. The vectors are always written first, so a reader
+    that sees the chunk list also sees at least that many vectors.
+
+    New stores are quantized as VECTOR_QUANTIZATION says, int8 with per-row
+    scales in NUMPY_SCALES_FILE or float16; a store keeps the format it was
+    created with. Quantized searches take NUMPY_RERANK_FACTOR times as many
+    candidates and re-score them with the exact embeddings when the embedding
+    function can return them from its cache.
+    """
+
+    def __init__(self, embedding_function, persist_directory, quantization=None):
+        self._embedding_function = embedding_function
+        self.persist_directory = persist_directory
+        self.quantization = quantization or VECTOR_QUANTIZATION
         
-        # Save the file temporarily
+        chunks = read_json(os.path.join(persist_directory, NUMPY_CHUNKS_FILE)) or {}
+        self._ids = chunks.get('ids', [])
+        self._documents = chunks.get('documents', [])
+        self._metadatas = chunks.get('metadatas', [])
+        self._positions = {id: position for position, id in enumerate(self._ids)}
+        self._vectors, self._scales = None, None
+        
+        if self._ids:
+            self._load()
+
+    def _load(self):
+        count = len(self._ids)
+        self._vectors = np.load(os.path.join(self.persist_directory, NUMPY_VECTORS_FILE), mmap_mode='r')[:count]
+        self.quantization = stored_quantization(self._vectors)
+        if self.quantization == 'int8':
+            self._scales = np.load(os.path.join(self.persist_directory, NUMPY_SCALES_FILE))[:count]
+
+    def _save(self, name, matrix):
+        path = os.path.join(self.persist_directory, name)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, matrix)
+        os.replace(tmp_path, path)
+
+    @property
+    def embeddings(self):
+        return self._embedding_function
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, ids=None, persist_directory=None, **kwargs):
+        vectorstore = cls(embedding, persist_directory)
+        vectorstore.add_texts(texts, metadatas=metadatas, ids=ids)
+        return vectorstore
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        """Embed and add texts, skipping IDs already in the store. Returns the IDs."""
+        texts = list(texts)
+        metadatas = list(metadatas) if metadatas else [{} for _ in texts]
+        ids = list(ids) if ids else [uuid.uuid4().hex for _ in texts]
+        
+        new = [
+            (id, text, metadata) for id, text, metadata in zip(ids, texts, metadatas)
+            if id not in self._positions
+        ]
+        if not new:
+            return ids
+        
+        vectors = self._normalize(self._embedding_function.embed_documents([text for _, text, _ in new]))
+        vectors, scales = quantize(vectors, self.quantization)
+        if self._vectors is not None:
+            vectors = np.concatenate([self._vectors, vectors])
+            if scales is not None:
+                scales = np.concatenate([self._scales, scales])
+        
+        os.makedirs(self.persist_directory, exist_ok=True)
+        if scales is not None:
+            self._save(NUMPY_SCALES_FILE, scales)
+        self._save(NUMPY_VECTORS_FILE, vectors)
+        
+        for id, text, metadata in new:
+            self._positions[id] = len(self._ids)
+            self._ids.append(id)
+            self._documents.append(text)
+            self._metadatas.append(metadata)
+        write_json(os.path.join(self.persist_directory, NUMPY_CHUNKS_FILE), {
+            'ids': self._ids,
+            'documents': self._documents,
+            'metadatas': self._metadatas,
+        })
+        
+        self._load()
+        return ids
+
+    def get(self, ids=None, where=None, include=None):
+        """Like Chroma.get: chunks by ID and/or metadata filter, with the fields in include."""
+        include = ['documents', 'metadatas'] if include is None else include
+        
+        if ids is None:
+            positions = range(len(self._ids))
+        else:
+            positions = [self._positions[id] for id in ids if id in self._positions]
+        if where:
+            positions = [position for position in positions if metadata_matches(self._metadatas[position], where)]
+        
+        result = {'ids': [self._ids[position] for position in positions]}
+        if 'documents' in include:
+            result['documents'] = [self._documents[position] for position in positions]
+        if 'metadatas' in include:
+            result['metadatas'] = [self._metadatas[position] for position in positions]
+        if 'embeddings' in include:
+            result['embeddings'] = self._dequantize(np.asarray(positions, dtype=np.int64)).tolist()
+        return result
+
+    def _dequantize(self, positions):
+        scales = self._scales[positions] if self._scales is not None else None
+        return dequantize(self._vectors[positions], scales)
+
+    def _scores(self, query, positions=None):
+        """Approximate cosine similarity of the query to each row, a block at a time."""
+        count = len(self._ids) if positions is None else len(positions)
+        scores = np.empty(count, dtype=np.float32)
+        for start in range(0, count, NUMPY_SCORE_BLOCK_ROWS):
+            block = slice(start, start + NUMPY_SCORE_BLOCK_ROWS)
+            rows = np.arange(count)[block] if positions is None else positions[block]
+            scores[block] = self._dequantize(rows) @ query
+        return scores
+
+    def _rescore(self, query, positions, scores):
+        """
+        Replace approximate scores with exact ones wherever the exact embedding
+        is cached. Candidates missing from the cache keep their approximate
+        score, and the shortfall is logged.
+        """
+        if self.quantization == 'none':
+            return scores
+        cached_vectors = getattr(self._embedding_function, 'cached_vectors', None)
+        exact = cached_vectors([self._documents[position] for position in positions]) if cached_vectors else []
+        
+        scores = scores.copy()
+        rescored = 0
+        for i, vector in enumerate(exact):
+            if vector is not None:
+                scores[i] = float(self._normalize([vector])[0] @ query)
+                rescored += 1
+        if rescored < len(positions):
+            print(f"Re-scored {rescored} of {len(positions)} candidates in {self.persist_directory} exactly; "
+                  f"the rest are missing from the embedding cache")
+        return scores
+
+    def similarity_search_by_vector_with_score(self, embedding, k=4, filter=None):
+        """Return the k chunks closest to an embedding by cosine similarity, with their scores."""
+        if not self._ids:
+            return []
+        
+        query = self._normalize([embedding])[0]
+        if filter:
+            positions = np.array(
+                [position for position, metadata in enumerate(self._metadatas) if metadata_matches(metadata, filter)],
+                dtype=np.int64,
+            )
+        else:
+            positions = np.arange(len(self._ids))
+        if not len(positions) or k <= 0:
+            return []
+        scores = self._scores(query, None if filter is None else positions)
+        
+        # Quantized scores only pick the candidates that are re-scored exactly
+        candidates = min(len(scores), k * NUMPY_RERANK_FACTOR if self.quantization != 'none' else k)
+        top = np.argpartition(-scores, candidates - 1)[:candidates]
+        scores = self._rescore(query, positions[top], scores[top])
+        order = np.argsort(-scores)[:k]
+        
+        results = []
+        for candidate in order:
+            position = int(positions[top[candidate]])
+            document = Document(page_content=self._documents[position], metadata=dict(self._metadatas[position]))
+            results.append((document, float(scores[candidate])))
+        return results
+
+    def similarity_search_by_vector(self, embedding, k=4, filter=None, **kwargs):
+        return [document for document, _ in self.similarity_search_by_vector_with_score(embedding, k, filter)]
+
+    def similarity_search_with_score(self, query, k=4, filter=None, **kwargs):
+        return self.similarity_search_by_vector_with_score(self.embeddings.embed_query(query), k, filter)
+
+    def similarity_search(self, query, k=4, filter=None, **kwargs):
+        return self.similarity_search_by_vector(self.embeddings.embed_query(query), k, filter)
+
+    @staticmethod
+    def _normalize(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms == 0, 1.0, norms)
+
+_shared_store = None
+_shared_store_lock = threading.Lock()
+
+def get_shared_store():
+    """Open the collection shared by every index, once per worker."""
+    global _shared_store
+    with _shared_store_lock:
+        if _shared_store is None:
+            _shared_store = Chroma(
+                collection_name=SHARED_COLLECTION,
+                embedding_function=BatchedEmbeddings(
+                    get_embedding_function(OPENAI_API_KEY), cache=embedding_cache
+                ),
+                persist_directory=SHARED_STORE_DIR,
+            )
+    return _shared_store
+
+class SharedIndex:
+    """
+    One index's part of the shared collection, with the parts of the Chroma
+    interface the API uses. Chunks are tagged with the index name in their
+    'session_id' metadata and every read is filtered on it. Chunk IDs are
+    prefixed with it too, so several indexes can hold the same chunk.
+    """
+
+    def __init__(self, store, index_name):
+        self.store = store
+        self.index_name = index_name
+        self._prefix = f"{index_name}:"
+
+    @property
+    def embeddings(self):
+        return self.store.embeddings
+
+    def _where(self, filter=None):
+        where = {'session_id': self.index_name}
+        return {'$and': [where, filter]} if filter else where
+
+    def add_documents(self, documents, ids):
+        """Embed and add chunks to the index."""
+        for document in documents:
+            document.metadata['session_id'] = self.index_name
+        return self.store.add_documents(documents, ids=[self._prefix + id for id in ids])
+
+    def add_embeddings(self, ids, embeddings, metadatas, documents):
+        """Add already embedded chunks to the index, in batches Chroma accepts."""
+        for start in range(0, len(ids), SHARED_UPSERT_BATCH):
+            end = start + SHARED_UPSERT_BATCH
+            self.store._collection.upsert(
+                ids=[self._prefix + id for id in ids[start:end]],
+                embeddings=embeddings[start:end],
+                metadatas=[{**(metadata or {}), 'session_id': self.index_name} for metadata in metadatas[start:end]],
+                documents=documents[start:end],
+            )
+
+    def get(self, ids=None, include=None):
+        """Like Chroma.get, limited to this index."""
+        data = self.store.get(
+            ids=[self._prefix + id for id in ids] if ids is not None else None,
+            where=self._where(),
+            include=include,
+        )
+        data['ids'] = [id[len(self._prefix):] for id in data['ids']]
+        return data
+
+    def similarity_search(self, query, k=4, filter=None):
+        return self.store.similarity_search(query, k=k, filter=self._where(filter))
+
+    def similarity_search_by_vector(self, embedding, k=4, filter=None):
+        return self.store.similarity_search_by_vector(embedding, k=k, filter=self._where(filter))
+
+    def delete(self):
+        """Delete every chunk of this index."""
+        self.store._collection.delete(where=self._where())
+
+    def copy_to(self, index_name):
+        """Copy every chunk of this index into another index."""
+        data = self.get(include=['embeddings', 'metadatas', 'documents'])
+        SharedIndex(self.store, index_name).add_embeddings(
+            data['ids'], data['embeddings'], data['metadatas'], data['documents']
+        )
+
+def open_index(persist_dir):
+    """Return the vector store for an index, opening it if this worker has not yet."""
+    if VECTOR_STORE_MODE == 'shared':
+        return SharedIndex(get_shared_store(), os.path.basename(persist_dir))
+    return vectorstore_cache.get(os.path.basename(persist_dir), persist_dir)
+
+def directory_signature(path):
+    """
+    Return (file count, total bytes, latest mtime) for a directory, or None if
+    it does not exist. SQLite journal files are skipped since reads touch them.
+    """
+    if not os.path.isdir(path):
+        return None
+    
+    count, size, mtime = 0, 0, 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            if file.endswith(('-wal', '-shm', '-journal')):
+                continue
+            try:
+                stat = os.stat(os.path.join(root, file))
+            except FileNotFoundError:
+                continue
+            count += 1
+            size += stat.st_size
+            mtime = max(mtime, stat.st_mtime_ns)
+    return count, size, mtime
+
+class VectorStoreCache:
+    """
+    An LRU of open vector stores keyed by index name, so sessions that share
+    an index also share its open store.
+
+    Entries are bounded by count and by memory, estimated from the size of the
+    store on disk. Entries idle for longer than idle_seconds are dropped, and an
+    entry is reloaded when its directory changes underneath it.
+
+    Dropped Chroma stores have their chromadb client system released, so the
+    memory is actually freed and a reload sees documents added since.
+    """
+
+    def __init__(self, max_entries, max_bytes, idle_seconds):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, index_name, persist_dir):
+        """Return the open vector store for an index, loading it if needed."""
+        signature = directory_signature(persist_dir)
+        
+        with self._lock:
+            self._evict_idle()
+            entry = self._entries.get(index_name)
+            if entry is not None:
+                if entry['signature'] == signature:
+                    entry['last_used'] = time.time()
+                    self._entries.move_to_end(index_name)
+                    return entry['vectorstore']
+                self._drop(index_name)
+        
+        # Load outside the lock so one slow open doesn't block other sessions
+        vectorstore = load_vectorstore(persist_dir)
+        signature = directory_signature(persist_dir)
+        
+        with self._lock:
+            self._entries[index_name] = {
+                'vectorstore': vectorstore,
+                'signature': signature,
+                'size': signature[1] if signature else 0,
+                'last_used': time.time(),
+            }
+            self._entries.move_to_end(index_name)
+            self._evict_over_budget()
+        
+        return vectorstore
+
+    def invalidate(self, index_name):
+        """Drop an index's vector store from the cache."""
+        with self._lock:
+            self._drop(index_name)
+
+    def _drop(self, index_name):
+        entry = self._entries.pop(index_name, None)
+        if entry is not None:
+            # Requests and background jobs may still hold the store, so it is
+            # left to be freed once they finish rather than stopped here
+            close_vectorstore(entry['vectorstore'], stop=False)
+        return entry
+
+    def _evict_idle(self):
+        cutoff = time.time() - self.idle_seconds
+        for index_name in [name for name, entry in self._entries.items() if entry['last_used'] < cutoff]:
+            self._drop(index_name)
+
+    def _evict_over_budget(self):
+        # Always keep the most recently used entry, even if it alone is over budget
+        total = sum(entry['size'] for entry in self._entries.values())
+        while len(self._entries) > 1 and (len(self._entries) > self.max_entries or total > self.max_bytes):
+            total -= self._drop(next(iter(self._entries)))['size']
+
+vectorstore_cache = VectorStoreCache(
+    VECTORSTORE_CACHE_MAX_ENTRIES,
+    VECTORSTORE_CACHE_MAX_MB * 1024 * 1024,
+    VECTORSTORE_CACHE_IDLE_SECONDS,
+)
+
+class AnswerCache:
+    """
+    Answers to recent questions, per index and kept separately for each
+    variant of a query, e.g. structured or plain responses, or the documents
+    searched. A question hits the cache when its embedding is within
+    threshold cosine similarity of a cached question's. Entries expire after
+    ttl_seconds, and the least recently used are evicted past max_entries.
+    """
+
+    def __init__(self, threshold, ttl_seconds, max_entries):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, index_name, variant, question_vector):
+        """Return the cached answer for the closest matching question, or None."""
+        vector = self._normalize(question_vector)
+        now = time.time()
+        
+        with self._lock:
+            best_key, best_score = None, self.threshold
+            for key, entry in list(self._entries.items()):
+                if now - entry['created_at'] > self.ttl_seconds:
+                    del self._entries[key]
+                    continue
+                if entry['index_name'] != index_name or entry['variant'] != variant:
+                    continue
+                score = float(np.dot(vector, entry['vector']))
+                if score >= best_score:
+                    best_key, best_score = key, score
+            
+            if best_key is None:
+                self.misses += 1
+                return None
+            
+            self.hits += 1
+            self._entries.move_to_end(best_key)
+            return self._entries[best_key]['answer']
+
+    def put(self, index_name, variant, question_vector, answer):
+        """Cache an answer to a question."""
+        with self._lock:
+            self._entries[uuid.uuid4().hex] = {
+                'index_name': index_name,
+                'variant': variant,
+                'vector': self._normalize(question_vector),
+                'answer': answer,
+                'created_at': time.time(),
+            }
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, index_name):
+        """Drop every cached answer for an index."""
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if entry['index_name'] == index_name]:
+                del self._entries[key]
+
+    def stats(self):
+        """Return the cache's size and hit/miss counters."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+answer_cache = AnswerCache(
+    ANSWER_CACHE_THRESHOLD, ANSWER_CACHE_TTL_SECONDS, ANSWER_CACHE_MAX_ENTRIES
+) if ANSWER_CACHE_ENABLED else None
+
+def document_filter(document_ids):
+    """Return a metadata filter restricting a search to some documents, or None for all."""
+    if not document_ids:
+        return None
+    if len(document_ids) == 1:
+        return {'document_id': document_ids[0]}
+    return {'document_id': {'$in': list(document_ids)}}
+
+STOPWORDS = frozenset(
+    "a an and are as at be by did do does for from had has have how in is it its of on or "
+    "that the their there these this those to was were what when where which who whom why "
+    "will with".split()
+)
+
+def tokenize(text):
+    """Split text into lowercase terms for BM25, keeping numbers and dropping stopwords."""
+    return [term for term in re.findall(r"\w+", text.lower()) if term not in STOPWORDS]
+
+class BM25Index:
+    """
+    An inverted index over an index's chunks, scored with BM25 so that exact
+    terms such as names, years and acronyms are found even when the embedding
+    of the question is not close to the chunk's. Saved as BM25_FILE next to
+    the vector store and extended as documents are added.
+    """
+
+    k1 = 1.5
+    b = 0.75
+
+    def __init__(self, ids=None, lengths=None, document_ids=None, postings=None):
+        self.ids = ids or []
+        self.lengths = lengths or []
+        self.document_ids = document_ids or []
+        self.postings = postings or {}
+        self._positions = {id: position for position, id in enumerate(self.ids)}
+
+    @classmethod
+    def load(cls, index_dir):
+        """Load an index's BM25 index, or return an empty one if it has none."""
+        return cls(**(read_json(os.path.join(index_dir, BM25_FILE)) or {}))
+
+    def save(self, index_dir):
+        write_json(os.path.join(index_dir, BM25_FILE), {
+            'ids': self.ids,
+            'lengths': self.lengths,
+            'document_ids': self.document_ids,
+            'postings': self.postings,
+        })
+
+    def add(self, chunks):
+        """Index (chunk, ID) pairs, skipping IDs already indexed."""
+        for chunk, id in chunks:
+            if id in self._positions:
+                continue
+            position = len(self.ids)
+            self._positions[id] = position
+            self.ids.append(id)
+            self.document_ids.append(chunk.metadata.get('document_id'))
+            
+            terms = tokenize(chunk.page_content)
+            self.lengths.append(len(terms))
+            counts = {}
+            for term in terms:
+                counts[term] = counts.get(term, 0) + 1
+            for term, count in counts.items():
+                self.postings.setdefault(term, []).append([position, count])
+
+    def search(self, query, k, document_ids=None):
+        """Return the IDs of the k best matching chunks, best first, optionally only from some documents."""
+        if not self.ids:
+            return []
+        
+        count = len(self.ids)
+        average_length = sum(self.lengths) / count or 1.0
+        allowed = set(document_ids) if document_ids else None
+        scores = {}
+        
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for position, frequency in postings:
+                if allowed is not None and self.document_ids[position] not in allowed:
+                    continue
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[position] / average_length)
+                scores[position] = scores.get(position, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + norm)
+        
+        best = sorted(scores, key=scores.get, reverse=True)[:k]
+        return [self.ids[position] for position in best]
+
+_bm25_indexes = OrderedDict()
+_bm25_lock = threading.Lock()
+
+def get_bm25_index(index_dir):
+    """Return an index's BM25 index, reusing this worker's copy until the file changes."""
+    path = os.path.join(index_dir, BM25_FILE)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    
+    with _bm25_lock:
+        entry = _bm25_indexes.get(index_dir)
+        if entry and entry[0] == mtime:
+            _bm25_indexes.move_to_end(index_dir)
+            return entry[1]
+    
+    bm25 = BM25Index.load(index_dir)
+    with _bm25_lock:
+        _bm25_indexes[index_dir] = (mtime, bm25)
+        _bm25_indexes.move_to_end(index_dir)
+        while len(_bm25_indexes) > VECTORSTORE_CACHE_MAX_ENTRIES:
+            _bm25_indexes.popitem(last=False)
+    return bm25
+
+def retrieve(vectorstore, index_dir, question, question_vector, document_ids=None, k=RETRIEVAL_K):
+    """
+    Retrieve the chunks for a question. Vector search results are fused with
+    BM25 results by reciprocal rank fusion when the index has a BM25 index;
+    indexes built before hybrid search use vector search alone.
+    """
+    search_filter = document_filter(document_ids)
+    bm25 = get_bm25_index(index_dir) if HYBRID_SEARCH_ENABLED else None
+    if bm25 is None:
+        return vectorstore.similarity_search_by_vector(question_vector, k=k, filter=search_filter)
+    
+    vector_docs = vectorstore.similarity_search_by_vector(question_vector, k=HYBRID_CANDIDATES, filter=search_filter)
+    lexical_ids = bm25.search(question, HYBRID_CANDIDATES, document_ids)
+    
+    docs = {chunk_id(doc): doc for doc in vector_docs}
+    scores = {}
+    for ranking in ([chunk_id(doc) for doc in vector_docs], lexical_ids):
+        for rank, id in enumerate(ranking, start=1):
+            scores[id] = scores.get(id, 0.0) + 1.0 / (HYBRID_RRF_K + rank)
+    best = sorted(scores, key=scores.get, reverse=True)[:k]
+    
+    # Chunks only found by BM25 are fetched from the vector store
+    missing = [id for id in best if id not in docs]
+    if missing:
+        data = vectorstore.get(ids=missing, include=['documents', 'metadatas'])
+        for id, text, metadata in zip(data['ids'], data['documents'], data['metadatas']):
+            docs[id] = Document(page_content=text, metadata=metadata or {})
+    
+    return [docs[id] for id in best if id in docs]
+
+def overlap_length(first, second, min_chars=CHUNK_OVERLAP_MIN_CHARS, max_chars=CHUNK_OVERLAP_MAX_CHARS):
+    """
+    Return the length of the longest end of first that second starts with,
+    or 0 if it is shorter than min_chars and so likely a coincidence.
+    """
+    for length in range(min(len(first), len(second), max_chars), min_chars - 1, -1):
+        if first.endswith(second[:length]):
+            return length
+    return 0
+
+def format_docs(docs, max_tokens=CONTEXT_MAX_TOKENS):
+    """
+    Format a list of Document objects, best first, into a single string of at
+    most max_tokens tokens for the chat model.
+
+    Text a chunk shares with an already included chunk of the same document,
+    from the splitter's chunk overlap, is only included once. The first chunk
+    that does not fit is trimmed to the remaining budget and the rest dropped.
+    """
+    separator_tokens = count_llm_tokens("\n\n")
+    packed, used = [], 0
+    
+    for doc in docs:
+        text = doc.page_content
+        document_id = doc.metadata.get('document_id')
+        for other, other_text in packed:
+            if other.metadata.get('document_id') != document_id:
+                continue
+            text = text[overlap_length(other_text, text):]
+            text = text[:len(text) - overlap_length(text, other_text)]
+        if not text.strip():
+            continue
+        
+        tokens = llm_encoding.encode(text, disallowed_special=())
+        remaining = max_tokens - used - (separator_tokens if packed else 0)
+        if len(tokens) > remaining:
+            if remaining >= CONTEXT_MIN_TRIM_TOKENS:
+                packed.append((doc, llm_encoding.decode(tokens[:remaining])))
+            break
+        
+        packed.append((doc, text))
+        used += len(tokens) + (separator_tokens if len(packed) > 1 else 0)
+    
+    return "\n\n".join(text for _, text in packed)
+
+def sse_event(event, data):
+    """Format a Server-Sent Event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def answer_question(question, docs):
+    """Answer a question from already retrieved chunks."""
+    chain = ChatPromptTemplate.from_template(ANSWER_TEMPLATE) | llm
+    response = chain.invoke({"context": format_docs(docs), "question": question})
+    return response.content
+
+def stream_answer(question, docs, on_complete=None):
+    """
+    Answer a question from already retrieved chunks as a stream of Server-Sent
+    Events: a 'token' event for each piece of the answer as the LLM produces
+    it, then a 'sources' event with the chunks and a final 'done' event.
+
+    If given, on_complete(answer) is called with the full answer once done.
+    """
+    sources = [{'content': doc.page_content, 'metadata': doc.metadata} for doc in docs]
+    
+    try:
+        chain = ChatPromptTemplate.from_template(ANSWER_TEMPLATE) | llm
+        
+        answer = []
+        for chunk in chain.stream({"context": format_docs(docs), "question": question}):
+            if chunk.content:
+                answer.append(chunk.content)
+                yield sse_event('token', {'content': chunk.content})
+        
+        yield sse_event('sources', {'sources': sources})
+        yield sse_event('done', {})
+        
+        if on_complete:
+            on_complete({'answer': ''.join(answer), 'sources': sources})
+    except Exception as e:
+        print(f"Error streaming answer: {e}")
+        yield sse_event('error', {'error': str(e)})
+
+def stream_cached_answer(cached):
+    """Replay a cached answer as the same events stream_answer sends."""
+    yield sse_event('token', {'content': cached['answer']})
+    yield sse_event('sources', {'sources': cached['sources']})
+    yield sse_event('done', {})
+
+def query_document(vectorstore, query, docs=None):
+    """
+    Query a vector store with a question and return a structured response.
+    Chunks are retrieved for the question unless already given.
+    """
+    if docs is None:
+        docs = vectorstore.similarity_search(query)
+    
+    prompt_template = ChatPromptTemplate.from_template(PROMPT_TEMPLATE)
+
+    rag_chain = prompt_template | llm.with_structured_output(ExtractedInfoWithSources)
+
+    structured_response = rag_chain.invoke({"context": format_docs(docs), "question": query})
+    
+    # Convert to dictionary for easier JSON serialization
+    return structured_response.dict()
+
+_field_vectors = {}
+
+def field_question_vectors(embeddings):
+    """
+    Return the embedding of each of FIELD_QUESTIONS. They never change, so
+    they are embedded with one call the first time and kept for the worker.
+    """
+    model = getattr(getattr(embeddings, 'embeddings', embeddings), 'model', None)
+    if model not in _field_vectors:
+        _field_vectors[model] = dict(zip(FIELD_QUESTIONS, embeddings.embed_documents(list(FIELD_QUESTIONS.values()))))
+    return _field_vectors[model]
+
+def extract_fields(vectorstore, index_dir, document_ids=None, contexts=None):
+    """
+    Return the same structured response as query_document, with each field
+    extracted from the chunks retrieved for its own question. The field
+    prompts run concurrently, so the response takes as long as the slowest
+    field rather than one prompt answering all four.
+
+    contexts can give the context for some fields instead of retrieving it.
+    """
+    contexts = contexts or {}
+    vectors = field_question_vectors(vectorstore.embeddings)
+    inputs = []
+    for field, question in FIELD_QUESTIONS.items():
+        context = contexts.get(field)
+        if context is None:
+            docs = retrieve(vectorstore, index_dir, question, vectors[field], document_ids)
+            context = format_docs(docs, FIELD_CONTEXT_MAX_TOKENS)
+        inputs.append({"context": context, "question": question})
+    
+    chain = ChatPromptTemplate.from_template(PROMPT_TEMPLATE) | llm.with_structured_output(AnswerWithSources)
+    answers = chain.batch(inputs, config={"max_concurrency": len(inputs)})
+    
+    return ExtractedInfoWithSources(**dict(zip(FIELD_QUESTIONS, answers))).dict()
+
+def read_front_matter(pdf_path):
+    """Return a PDF's document info and the text of its first pages, within FIELD_CONTEXT_MAX_TOKENS."""
+    reader = PdfReader(pdf_path)
+    info = reader.metadata
+    lines = []
+    if info:
+        if info.title:
+            lines.append(f"Title: {info.title}")
+        if info.author:
+            lines.append(f"Author: {info.author}")
+        try:
+            if info.creation_date:
+                lines.append(f"Created: {info.creation_date:%Y-%m-%d}")
+        except ValueError:
+            # Some PDFs carry dates pypdf cannot parse
+            pass
+    
+    pages = [reader.pages[i].extract_text() or '' for i in range(min(METADATA_FRONT_PAGES, len(reader.pages)))]
+    text = "PDF document info:\n" + "\n".join(lines) + "\n\nFirst pages:\n" + "\n\n".join(pages)
+    return llm_encoding.decode(llm_encoding.encode(text, disallowed_special=())[:FIELD_CONTEXT_MAX_TOKENS])
+
+def extract_document_metadata(front_matter, vectorstore, persist_dir, document_id, filename):
+    """
+    Extract a document's structured fields once, at ingest. Title, year and
+    authors come from its front matter, and the summary field from the
+    document's chunks. Until they are stored, structured queries fall back
+    to extracting at query time.
+    """
+    try:
+        fields = extract_fields(
+            vectorstore, persist_dir, [document_id],
+            contexts={field: front_matter for field in FRONT_MATTER_FIELDS},
+        )
+        write_document_metadata(persist_dir, document_id, fields)
+    except Exception as e:
+        print(f"Error extracting metadata for {filename}: {e}")
+
+def write_document_metadata(index_dir, document_id, fields):
+    """Store a document's structured fields with its index."""
+    path = os.path.join(index_dir, METADATA_FILE)
+    # Fields of several documents can be extracted at once in the background
+    with file_lock(path + '.lock'):
+        metadata = read_json(path) or {'documents': {}}
+        metadata['documents'][document_id] = {'fields': fields, 'extracted_at': time.time()}
+        write_json(path, metadata)
+
+def single_document_id(index_dir, document_ids=None):
+    """Return the ID of the one document a query covers, or None if it covers several."""
+    if document_ids:
+        return document_ids[0] if len(set(document_ids)) == 1 else None
+    documents = read_documents(index_dir)
+    return documents[0]['document_id'] if len(documents) == 1 else None
+
+def read_document_metadata(index_dir, document_id):
+    """Return a document's stored structured fields, or None if they were not extracted."""
+    entry = (read_json(os.path.join(index_dir, METADATA_FILE)) or {}).get('documents', {}).get(document_id)
+    return entry['fields'] if entry else None
+
+# Ingestion jobs
+def job_path(job_id):
+    """Return the path of the JSON file holding a job's state."""
+    return os.path.join(JOBS_DIR, f"{job_id}.json")
+
+def save_job(job):
+    """
+    Persist a job's state. Jobs are kept on disk rather than in memory so that
+    any gunicorn worker can answer /jobs/<id>, not just the one running it.
+    """
+    job['updated_at'] = time.time()
+    write_json(job_path(job['job_id']), job)
+
+def load_job(job_id):
+    """
+    Load a job's state, or return None if the job does not exist. Queued or
+    running jobs not updated in INGEST_STALE_SECONDS were lost when their
+    worker stopped, and are reported as failed.
+    """
+    job = read_json(job_path(job_id))
+    if job and job['status'] in ('queued', 'running') and time.time() - job['updated_at'] > INGEST_STALE_SECONDS:
+        job['status'] = 'failed'
+        job['error'] = 'Processing was interrupted. Please upload the file again.'
+    return job
+
+def run_ingest_job(job, pdf_path):
+    """
+    Run process_pdf for a queued job, or add_pdf_to_session if the job adds a
+    document to an existing session, recording progress as it goes.
+    """
+    def progress(stage):
+        # Stages overlap once pages stream through, so record each one once
+        if stage in job['stages']:
+            return
+        now = time.time()
+        if job['stage'] in job['stages']:
+            job['stages'][job['stage']]['finished_at'] = now
+        job['stage'] = stage
+        job['stages'][stage] = {'started_at': now, 'finished_at': None}
+        job['progress'] = INGEST_STAGES.index(stage) / len(INGEST_STAGES)
+        save_job(job)
+
+    job['status'] = 'running'
+    job['started_at'] = time.time()
+    save_job(job)
+
+    try:
+        if job['append']:
+            document_id, added = add_pdf_to_session(
+                pdf_path, job['session_id'], progress=progress,
+                document_hash=job['document_hash'], filename=job['filename'],
+            )
+            job['document_id'] = document_id
+            job['added'] = added
+        else:
+            vector_store_path, summary = process_pdf(
+                pdf_path, job['session_id'], progress=progress,
+                document_hash=job['document_hash'], filename=job['filename'],
+            )
+            job['summary'] = summary
+        job['status'] = 'completed'
+        job['progress'] = 1.0
+    except Exception as e:
+        print(f"Error processing job {job['job_id']}: {e}")
+        job['status'] = 'failed'
+        job['error'] = str(e)
+    finally:
+        if job['stage'] in job['stages']:
+            job['stages'][job['stage']]['finished_at'] = time.time()
+        job['finished_at'] = time.time()
+        save_job(job)
+
+        # Clean up the uploaded file and free the queue slot
+        os.remove(pdf_path)
+        os.rmdir(os.path.dirname(pdf_path))
+        ingest_slots.release()
+
+def enqueue_ingest_job(file, session_id, document_hash=None, append=False):
+    """
+    Save an uploaded file and queue it for background processing, as a new
+    session or, if append is set, as a document added to an existing one.
+
+    Returns the new job, or None if the ingestion queue is full.
+    """
+    if not ingest_slots.acquire(blocking=False):
+        return None
+
+    try:
+        job_id = str(uuid.uuid4())
+        job_dir = os.path.join(UPLOAD_FOLDER, job_id)
+        os.makedirs(job_dir, exist_ok=True)
+        pdf_path = os.path.join(job_dir, secure_filename(file.filename))
+        file.save(pdf_path)
+
+        job = {
+            'job_id': job_id,
+            'session_id': session_id,
+            'document_hash': document_hash,
+            'append': append,
+            'filename': file.filename,
+            'status': 'queued',
+            'stage': None,
+            'stages': {},
+            'progress': 0.0,
+            'summary': None,
+            'error': None,
+            'created_at': time.time(),
+            'started_at': None,
+            'finished_at': None,
+        }
+        save_job(job)
+        ingest_executor.submit(run_ingest_job, job, pdf_path)
+    except Exception:
+        ingest_slots.release()
+        raise
+
+    return job
+
+# Disk housekeeping
+_touched = {}
+
+def touch_session(session_id):
+    """
+    Record that a session was used. Writes are skipped if this worker already
+    recorded a use within SESSION_TOUCH_INTERVAL, to keep queries cheap.
+    """
+    now = time.time()
+    if now - _touched.get(session_id, 0) < SESSION_TOUCH_INTERVAL:
+        return
+    _touched[session_id] = now
+    session_registry.touch(session_id)
+
+def delete_index(index_name):
+    """Delete an index and everything stored for it. No session may still use it."""
+    if not is_index_name(index_name):
+        raise ValueError(f"Not an index: {index_name!r}")
+    session_registry.remove_documents(index_name)
+    if VECTOR_STORE_MODE == 'shared':
+        SharedIndex(get_shared_store(), index_name).delete()
+    shutil.rmtree(os.path.join(VECTOR_STORE_DIR, index_name), ignore_errors=True)
+    vectorstore_cache.invalidate(index_name)
+    if answer_cache:
+        answer_cache.invalidate(index_name)
+
+def index_usage():
+    """
+    Return {index_name: {'size', 'last_used', 'sessions'}} for every index
+    directory. Sessions created before the registry have no row, so their
+    index counts as last used when its directory last changed.
+    """
+    sessions = {}
+    for session_id, index_name, created_at, last_access in session_registry.sessions():
+        sessions.setdefault(index_name, []).append((session_id, last_access))
+    
+    usage = {}
+    for index_name in os.listdir(VECTOR_STORE_DIR):
+        # Anything that is not an index is prefixed with '_'
+        signature = directory_signature(os.path.join(VECTOR_STORE_DIR, index_name))
+        if index_name.startswith('_') or signature is None:
+            continue
+        
+        _, size, mtime = signature
+        index_sessions = sessions.get(index_name, [])
+        usage[index_name] = {
+            'size': size,
+            'last_used': max((last_access for _, last_access in index_sessions), default=mtime / 1e9),
+            'sessions': [session_id for session_id, _ in index_sessions],
+        }
+    return usage
+
+def storage_overhead():
+    """
+    Return the bytes under VECTOR_STORE_DIR that belong to no one index: the
+    embedding and summary caches, the session registry and the shared collection.
+    """
+    size = 0
+    for name in os.listdir(VECTOR_STORE_DIR):
+        path = os.path.join(VECTOR_STORE_DIR, name)
+        if not name.startswith('_'):
+            continue
+        if os.path.isdir(path):
+            signature = directory_signature(path)
+            size += signature[1] if signature else 0
+        else:
+            try:
+                size += os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+    return size
+
+def prune_caches():
+    """Delete embedding and partial summary cache entries unused for CACHE_MAX_AGE_SECONDS."""
+    if not CACHE_MAX_AGE_SECONDS:
+        return 0
+    
+    cutoff = time.time() - CACHE_MAX_AGE_SECONDS
+    pruned = partial_summary_cache.prune(cutoff)
+    if embedding_cache:
+        pruned += embedding_cache.prune(cutoff)
+    return pruned
+
+def reap_expired_sessions():
+    """Delete sessions unused for SESSION_TTL_SECONDS and any index left unused."""
+    if not SESSION_TTL_SECONDS:
+        return 0
+    
+    cutoff = time.time() - SESSION_TTL_SECONDS
+    expired = session_registry.expired_sessions(cutoff)
+    index_names = session_registry.remove_sessions(expired)
+    remove_session_locks(expired)
+    
+    # Unregistered indexes are reaped on their directory's age
+    for index_name, usage in index_usage().items():
+        if not usage['sessions'] and usage['last_used'] < cutoff:
+            index_names.add(index_name)
+    
+    reaped = 0
+    for index_name in index_names:
+        if not is_index_name(index_name):
+            print(f"Not reaping {index_name!r}: not an index directory")
+            continue
+        # Indexes shared through de-duplication stay while any session uses them
+        if session_registry.ref_count(index_name) == 0:
+            delete_index(index_name)
+            reaped += 1
+    return reaped
+
+def enforce_quota():
+    """
+    Delete the least recently used indexes, with their sessions, until
+    everything under VECTOR_STORE_DIR, caches included, fits in VECTORSTORE_QUOTA_MB.
+    """
+    if not VECTORSTORE_QUOTA_MB:
+        return 0
+    
+    quota = VECTORSTORE_QUOTA_MB * 1024 * 1024
+    overhead = storage_overhead()
+    if overhead >= quota:
+        # Deleting sessions cannot bring the caches under the quota
+        print(f"Caches and shared storage use {overhead} bytes, over the {quota} byte quota on their own")
+        return 0
+    
+    usage = index_usage()
+    total = sum(entry['size'] for entry in usage.values()) + overhead
+    evicted = 0
+    
+    for index_name, entry in sorted(usage.items(), key=lambda item: item[1]['last_used']):
+        if total <= quota:
+            break
+        session_registry.remove_sessions(entry['sessions'])
+        remove_session_locks(entry['sessions'])
+        delete_index(index_name)
+        total -= entry['size']
+        evicted += 1
+    return evicted
+
+def reap_uploads():
+    """Delete uploads and finished job records older than UPLOAD_MAX_AGE_SECONDS left behind by crashed workers."""
+    cutoff = time.time() - UPLOAD_MAX_AGE_SECONDS
+    removed = 0
+    
+    for job_id in os.listdir(UPLOAD_FOLDER):
+        path = os.path.join(UPLOAD_FOLDER, job_id)
+        job = load_job(job_id)
+        if os.path.getmtime(path) >= cutoff or (job and job['status'] in ('queued', 'running')):
+            continue
+        # A new session's interrupted job leaves an index without its document
+        if job and not job.get('append') and not read_documents(os.path.join(VECTOR_STORE_DIR, job['session_id'])):
+            delete_index(job['session_id'])
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+        removed += 1
+    
+    for name in os.listdir(JOBS_DIR):
+        path = os.path.join(JOBS_DIR, name)
+        job = load_job(os.path.splitext(name)[0])
+        if os.path.getmtime(path) < cutoff and (job is None or job['status'] in ('completed', 'failed')):
+            os.remove(path)
+    
+    return removed
+
+def reap():
+    """
+    Run every housekeeping step, unless another worker already is. Returns
+    the number of indexes and uploads deleted, or None if it did not run.
+    """
+    with open(REAPER_LOCK_PATH, 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        
+        # Caches are pruned first so the quota sees what they still hold
+        return {
+            'cache_entries': prune_caches(),
+            'expired': reap_expired_sessions(),
+            'evicted': enforce_quota(),
+            'uploads': reap_uploads(),
+        }
+
+def run_reaper():
+    """Run reap every REAPER_INTERVAL_SECONDS for the life of the worker."""
+    while True:
+        time.sleep(REAPER_INTERVAL_SECONDS * random.uniform(0.9, 1.1))
+        try:
+            result = reap()
+            if result:
+                print(f"Reaper deleted {result['expired']} expired and {result['evicted']} evicted indexes, "
+                      f"{result['uploads']} stale uploads and {result['cache_entries']} cache entries")
+        except Exception as e:
+            print(f"Error reaping sessions: {e}")
+
+# Not in child processes, which import this module when it is run as a script
+if REAPER_INTERVAL_SECONDS and multiprocessing.parent_process() is None:
+    threading.Thread(target=run_reaper, name='reaper', daemon=True).start()
+
+def admin_authorized():
+    """Return whether the request may use the admin endpoints; always refused if ADMIN_TOKEN is unset."""
+    if not ADMIN_TOKEN:
+        return False
+    token = request.headers.get('X-Admin-Token') or request.headers.get('Authorization', '').removeprefix('Bearer ')
+    return hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+# API Routes
+@app.route('/upload', methods=['POST'])
+def upload_pdf():
+    """Upload a PDF file and process it"""
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file part'}), 400
+    
+    file = request.files['file']
+    
+    if file.filename == '':
+        return jsonify({'error': 'No selected file'}), 400
+    
+    if file and file.filename.endswith('.pdf'):
+        # Generate a session ID
+        session_id = str(uuid.uuid4())
+        
+        # An identical document that was already processed shares its index
+        document_hash = hash_upload(file)
+        index_name = session_registry.find_document(document_hash)
+        if index_name:
+            session_registry.add_session(session_id, index_name, document_hash)
+            summary_data = read_summary(os.path.join(VECTOR_STORE_DIR, index_name)) or {}
+            
+            return jsonify({
+                'success': True,
+                'session_id': session_id,
+                'summary': summary_data.get('summary'),
+                'deduplicated': True,
+                'message': 'PDF processed successfully'
+            }), 200
+        
+        # Hand the file to the ingestion pool if asked to
+        run_async = request.values.get('async', str(ASYNC_INGEST)).lower() == 'true'
+        if run_async:
+            try:
+                job = enqueue_ingest_job(file, session_id, document_hash)
+            except Exception as e:
+                return jsonify({'error': str(e)}), 500
+            
+            if job is None:
+                return jsonify({'error': 'Ingestion queue is full. Please retry later.'}), 503
+            
+            return jsonify({
+                'success': True,
+                'job_id': job['job_id'],
+                'session_id': session_id,
+                'status': job['status'],
+                'message': 'PDF queued for processing'
+            }), 202
+        
+        # Save the file temporarily
         temp_dir = tempfile.mkdtemp()
         pdf_path = os.path.join(temp_dir, secure_filename(file.filename))
         file.save(pdf_path)
         
         try:
             # Process the PDF and get summary
-            vector_store_path, summary = process_pdf(pdf_path, session_id)
+            vector_store_path, summary = process_pdf(
+                pdf_path, session_id, document_hash=document_hash, filename=file.filename
+            )
             
             return jsonify({
                 'success': True,
@@ -268,32 +2559,282 @@ def query():
     if not session_id:
         return jsonify({'error': 'No session ID provided'}), 400
     
+    if not is_session_id(session_id):
+        return jsonify({'error': 'Invalid session ID'}), 400
+    
     if not question:
         return jsonify({'error': 'No question provided'}), 400
     
-    vector_store_path = os.path.join(VECTOR_STORE_DIR, session_id)
+    document_ids = data.get('document_ids')
+    if document_ids is not None and (
+        not isinstance(document_ids, list) or not document_ids
+        or not all(isinstance(document_id, str) for document_id in document_ids)
+    ):
+        return jsonify({'error': 'document_ids must be a non-empty list of document IDs'}), 400
+    
+    stream = data.get('stream', False) or 'text/event-stream' in request.headers.get('Accept', '')
+    if stream and data.get('structured', False):
+        return jsonify({'error': 'Streaming is not supported for structured responses'}), 400
+    
+    vector_store_path = session_index_dir(session_id)
     
     if not os.path.exists(vector_store_path):
         return jsonify({'error': 'Session not found'}), 404
     
+    touch_session(session_id)
+    
+    # Fields extracted at ingest are served from disk unless a refresh is asked for
+    refresh = str(data.get('refresh', request.args.get('refresh', 'false'))).lower() == 'true'
+    document_id = single_document_id(vector_store_path, document_ids) if data.get('structured', False) else None
+    if document_id and not refresh:
+        stored = read_document_metadata(vector_store_path, document_id)
+        if stored is not None:
+            return jsonify(stored), 200, {'X-Structured-Source': 'ingest'}
+    
     try:
-        # Load the vector store
-        vectorstore = load_vectorstore(vector_store_path)
+        # Get the vector store, reusing this worker's open handle if it has one
+        index_name = os.path.basename(vector_store_path)
+        vectorstore = open_index(vector_store_path)
+        structured = data.get('structured', False)
+        
+        # Answers are cached per response type and documents searched, and
+        # stop matching once documents are added to the session
+        variant = (
+            structured,
+            tuple(sorted(document_ids)) if document_ids else None,
+            index_generation(vector_store_path),
+        )
         
-        # Create a retrieval chain
-        if data.get('structured', False):
+        # Embed the question once, for both the answer cache and retrieval;
+        # field extraction retrieves with its own questions
+        fields_only = structured and STRUCTURED_EXTRACTION == 'fields'
+        question_vector = vectorstore.embeddings.embed_query(question) if answer_cache or not fields_only else None
+        cached = answer_cache.get(index_name, variant, question_vector) if answer_cache and not refresh else None
+        cache_status = {'X-Answer-Cache': 'hit' if cached is not None else 'miss'}
+        
+        def cache_answer(answer):
+            if answer_cache:
+                answer_cache.put(index_name, variant, question_vector, answer)
+        
+        # Stream the answer as it is generated
+        if stream:
+            events = stream_cached_answer(cached) if cached is not None else stream_answer(
+                question,
+                retrieve(vectorstore, vector_store_path, question, question_vector, document_ids),
+                on_complete=cache_answer,
+            )
+            return Response(
+                stream_with_context(events),
+                mimetype='text/event-stream',
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no', **cache_status},
+            )
+        
+        if cached is not None:
+            result = cached if structured else {'answer': cached['answer']}
+            return jsonify(result), 200, cache_status
+        
+        if structured:
             # Return structured info
-            result = query_document(vectorstore, question)
-            return jsonify(result), 200
+            if STRUCTURED_EXTRACTION == 'fields':
+                result = extract_fields(vectorstore, vector_store_path, document_ids)
+            else:
+                docs = retrieve(vectorstore, vector_store_path, question, question_vector, document_ids)
+                result = query_document(vectorstore, question, docs)
+            cache_answer(result)
+            
+            # A refreshed extraction replaces the one stored at ingest
+            if refresh and document_id:
+                write_document_metadata(vector_store_path, document_id, result)
+            return jsonify(result), 200, cache_status
         else:
             # Return simple answer
-            chain = create_retrieval_chain(vectorstore)
-            response = chain.invoke(question)
-            return jsonify({'answer': response.content}), 200
+            docs = retrieve(vectorstore, vector_store_path, question, question_vector, document_ids)
+            answer = answer_question(question, docs)
+            cache_answer({
+                'answer': answer,
+                'sources': [{'content': doc.page_content, 'metadata': doc.metadata} for doc in docs],
+            })
+            return jsonify({'answer': answer}), 200, cache_status
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/sessions/<session_id>/summary', methods=['GET'])
+def session_summary(session_id):
+    """Return a session's document summary, waiting for it if it is being generated"""
+    if not is_session_id(session_id):
+        return jsonify({'error': 'Invalid session ID'}), 400
+    
+    index_dir = session_index_dir(session_id)
+    
+    if not os.path.exists(index_dir):
+        return jsonify({'error': 'Session not found'}), 404
+    
+    touch_session(session_id)
+    
+    wait_seconds = min(request.args.get('wait', SUMMARY_WAIT_SECONDS, type=float), SUMMARY_WAIT_SECONDS)
+    
+    try:
+        record = get_summary(index_dir, wait_seconds)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    
+    if record['status'] != 'ready':
+        return jsonify({'session_id': session_id, 'status': record['status']}), 202
+    
+    return jsonify({'session_id': session_id, 'status': 'ready', 'summary': record['summary']}), 200
+
+@app.route('/sessions/<session_id>/documents', methods=['POST'])
+def add_session_document(session_id):
+    """Add a PDF to an existing session"""
+    if not is_session_id(session_id):
+        return jsonify({'error': 'Invalid session ID'}), 400
+    
+    index_dir = session_index_dir(session_id)
+    
+    if not os.path.exists(index_dir):
+        return jsonify({'error': 'Session not found'}), 404
+    
+    touch_session(session_id)
+    
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file part'}), 400
+    
+    file = request.files['file']
+    
+    if file.filename == '':
+        return jsonify({'error': 'No selected file'}), 400
+    
+    if not file.filename.endswith('.pdf'):
+        return jsonify({'error': 'Invalid file format. Please upload a PDF.'}), 400
+    
+    document_hash = hash_upload(file)
+    
+    # Hand the file to the ingestion pool if asked to
+    run_async = request.values.get('async', str(ASYNC_INGEST)).lower() == 'true'
+    if run_async:
+        try:
+            job = enqueue_ingest_job(file, session_id, document_hash, append=True)
+        except Exception as e:
+            return jsonify({'error': str(e)}), 500
+        
+        if job is None:
+            return jsonify({'error': 'Ingestion queue is full. Please retry later.'}), 503
+        
+        return jsonify({
+            'success': True,
+            'job_id': job['job_id'],
+            'session_id': session_id,
+            'document_id': document_hash,
+            'status': job['status'],
+            'message': 'PDF queued for processing'
+        }), 202
+    
+    # Save the file temporarily
+    temp_dir = tempfile.mkdtemp()
+    pdf_path = os.path.join(temp_dir, secure_filename(file.filename))
+    file.save(pdf_path)
+    
+    try:
+        document_id, added = add_pdf_to_session(
+            pdf_path, session_id, document_hash=document_hash, filename=file.filename
+        )
+        
+        return jsonify({
+            'success': True,
+            'session_id': session_id,
+            'document_id': document_id,
+            'added': added,
+            'message': 'PDF added to session' if added else 'PDF is already in this session'
+        }), 200
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    
+    finally:
+        # Clean up the temporary file
+        os.remove(pdf_path)
+        os.rmdir(temp_dir)
+
+@app.route('/sessions/<session_id>/documents', methods=['GET'])
+def list_session_documents(session_id):
+    """List the documents in a session"""
+    if not is_session_id(session_id):
+        return jsonify({'error': 'Invalid session ID'}), 400
+    
+    index_dir = session_index_dir(session_id)
+    
+    if not os.path.exists(index_dir):
+        return jsonify({'error': 'Session not found'}), 404
+    
+    touch_session(session_id)
+    
+    return jsonify({'session_id': session_id, 'documents': read_documents(index_dir)}), 200
+
+@app.route('/admin/sessions', methods=['GET'])
+def admin_sessions():
+    """Report each session's index size and when it was last used"""
+    if not admin_authorized():
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    usage = index_usage()
+    overhead = storage_overhead()
+    sessions = [
+        {
+            'session_id': session_id,
+            'index_name': index_name,
+            'size_bytes': usage.get(index_name, {}).get('size', 0),
+            'shared_with': len(usage.get(index_name, {}).get('sessions', [])) - 1,
+            'created_at': created_at,
+            'last_access': last_access,
+        }
+        for session_id, index_name, created_at, last_access in session_registry.sessions()
+    ]
+    
+    return jsonify({
+        'sessions': sorted(sessions, key=lambda session: session['last_access']),
+        'indexes': len(usage),
+        'index_bytes': sum(entry['size'] for entry in usage.values()),
+        'other_bytes': overhead,
+        'total_bytes': sum(entry['size'] for entry in usage.values()) + overhead,
+        'quota_bytes': VECTORSTORE_QUOTA_MB * 1024 * 1024 or None,
+        'ttl_seconds': SESSION_TTL_SECONDS or None,
+    }), 200
+
+@app.route('/admin/reap', methods=['POST'])
+def admin_reap():
+    """Run session and upload cleanup now"""
+    if not admin_authorized():
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    try:
+        result = reap()
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    
+    if result is None:
+        return jsonify({'error': 'Cleanup is already running'}), 409
+    
+    return jsonify(result), 200
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Report the status and current stage of an ingestion job"""
+    job = load_job(job_id)
+    
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    return jsonify(job), 200
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    """Report this worker's answer cache counters"""
+    if answer_cache is None:
+        return jsonify({'enabled': False}), 200
+    
+    return jsonify({'enabled': True, **answer_cache.stats()}), 200
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
@@ -0,0 +1,26 @@
+"""
+Helpers for the chromadb clients behind LangChain's Chroma stores, shared by
+the API, its scripts and the Lambda handler.
+"""
+from chromadb.api.client import SharedSystemClient
+
+def close_vectorstore(vectorstore, stop=True):
+    """
+    Release the chromadb client system behind a Chroma store. chromadb keeps
+    one system, with its SQLite connections and HNSW indexes, per persist
+    directory for the life of the process, so dropping the store alone frees
+    nothing, and reopening the directory returns the same system with the
+    index as it was first loaded.
+
+    The system is forgotten, so the next open of the directory reads it
+    afresh. With stop it is also closed now; without, it is freed once
+    nothing uses it any more, which is the safe choice while other threads
+    may still hold a store on it. Other kinds of store are left alone.
+    """
+    client = getattr(vectorstore, '_client', None)
+    identifier = getattr(client, '_identifier', None)
+    if identifier is None:
+        return
+    system = SharedSystemClient._identifer_to_system.pop(identifier, None)
+    if system is not None and stop:
+        system.stop()
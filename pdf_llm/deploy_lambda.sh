@@ -66,7 +66,7 @@ fi
 # Create the Lambda function package
 echo "Creating Lambda function package..."
 mkdir -p "${TEMP_DIR}/function"
-cp lambda_handler.py "${TEMP_DIR}/function/"
+cp lambda_handler.py chroma_clients.py "${TEMP_DIR}/function/"
 cp .env "${TEMP_DIR}/function/" 2>/dev/null || echo "Warning: .env file not found, make sure environment variables are set in Lambda console"
 
 # Create a zip file for the function
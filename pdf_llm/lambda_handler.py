@@ -1,22 +1,40 @@
 import os
 import json
 import base64
-import tempfile
+import io
+import mmap
+import random
+import shutil
+import struct
+import time
 import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from email.message import Message
 from dotenv import load_dotenv
 # Updated imports for LangChain
-from langchain_community.document_loaders import PyPDFLoader
 from langchain_openai import OpenAIEmbeddings, ChatOpenAI
 from langchain_community.vectorstores import Chroma
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
 from langchain_core.runnables import RunnablePassthrough
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain.evaluation import load_evaluator
+import numpy as np
+import openai
+import tiktoken
+from pypdf import PdfReader
 
 # S3 imports
 import boto3
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
+from botocore.config import Config
 from werkzeug.utils import secure_filename
 
+from chroma_clients import close_vectorstore
+
 # Load environment variables
 load_dotenv()
 
@@ -31,7 +49,32 @@ llm = ChatOpenAI(model="gpt-4o-mini", temperature=0, openai_api_key=OPENAI_API_K
 
 # Configuration for S3
 S3_BUCKET = os.getenv('S3_BUCKET', 'pdf-llm-storage')
-s3_client = boto3.client('s3')
+S3_MAX_CONCURRENCY = int(os.getenv('S3_MAX_CONCURRENCY', 16))
+s3_client = boto3.client('s3', config=Config(max_pool_connections=S3_MAX_CONCURRENCY))
+
+# One transfer manager runs every index file transfer on a shared thread pool
+transfer_manager = create_transfer_manager(s3_client, TransferConfig(max_concurrency=S3_MAX_CONCURRENCY))
+
+# Embedding batches: sized in tokens, several in flight at once
+EMBEDDING_BATCH_TOKENS = int(os.getenv('EMBEDDING_BATCH_TOKENS', 20000))
+EMBEDDING_MAX_CONCURRENCY = int(os.getenv('EMBEDDING_MAX_CONCURRENCY', 4))
+EMBEDDING_MAX_RETRIES = int(os.getenv('EMBEDDING_MAX_RETRIES', 5))
+EMBEDDING_BACKOFF_BASE = float(os.getenv('EMBEDDING_BACKOFF_BASE', 1.0))
+EMBEDDING_BACKOFF_MAX = float(os.getenv('EMBEDDING_BACKOFF_MAX', 30.0))
+RETRYABLE_EMBEDDING_ERRORS = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError)
+
+# Session indexes are kept in /tmp between invocations of a warm container,
+# checked against S3 at most every LAMBDA_CACHE_REVALIDATE_SECONDS
+LAMBDA_CACHE_DIR = os.getenv('LAMBDA_CACHE_DIR', '/tmp/vectorstores')
+LAMBDA_CACHE_MAX_MB = int(os.getenv('LAMBDA_CACHE_MAX_MB', 384))
+LAMBDA_CACHE_REVALIDATE_SECONDS = int(os.getenv('LAMBDA_CACHE_REVALIDATE_SECONDS', 300))
+
+# New sessions are saved as one packed object ('packed') or as the files of a
+# Chroma store ('chroma'); sessions are loaded in whichever format they have
+LAMBDA_INDEX_FORMAT = os.getenv('LAMBDA_INDEX_FORMAT', 'packed').lower()
+PACKED_INDEX_FILE = 'index.pack'
+PACKED_MAGIC = b'PDFLLMP1'
+PACKED_PREAMBLE = struct.Struct('<8sIQQ')
 
 # Define prompt template for QA
 PROMPT_TEMPLATE = """
@@ -56,11 +99,197 @@ def get_embedding_function(api_key):
     )
     return embeddings
 
-def process_pdf(pdf_path, session_id):
-    """Process a PDF file and create a vector store"""
+class BatchedEmbeddings(Embeddings):
+    """
+    Wrap an embeddings model so that documents are embedded in batches bounded
+    by token count, several batches at a time, with rate-limited batches retried
+    using exponential backoff. Timing for each batch is logged.
+    """
+
+    def __init__(self, embeddings, batch_tokens=EMBEDDING_BATCH_TOKENS,
+                 max_concurrency=EMBEDDING_MAX_CONCURRENCY, max_retries=EMBEDDING_MAX_RETRIES):
+        self.embeddings = embeddings
+        self.batch_tokens = batch_tokens
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.encoding = tiktoken.encoding_for_model(embeddings.model)
+
+    def embed_documents(self, texts):
+        """Embed a list of texts, preserving their order."""
+        batches = self.make_batches(texts)
+        if not batches:
+            return []
+        
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(batches))) as executor:
+            results = list(executor.map(
+                lambda args: self._embed_batch(*args, len(batches)),
+                enumerate(batches),
+            ))
+        
+        total_tokens = sum(tokens for _, tokens in batches)
+        print(f"Embedded {len(texts)} chunks ({total_tokens} tokens) in {len(batches)} batches "
+              f"in {time.perf_counter() - start:.2f}s")
+        
+        return [vector for result in results for vector in result]
+
+    def embed_query(self, text):
+        """Embed a single query."""
+        return self.embeddings.embed_query(text)
+
+    def make_batches(self, texts):
+        """Group texts into (texts, token_count) batches of at most batch_tokens tokens."""
+        batches = []
+        batch, batch_tokens = [], 0
+        for text in texts:
+            tokens = len(self.encoding.encode(text, disallowed_special=()))
+            if batch and batch_tokens + tokens > self.batch_tokens:
+                batches.append((batch, batch_tokens))
+                batch, batch_tokens = [], 0
+            batch.append(text)
+            batch_tokens += tokens
+        if batch:
+            batches.append((batch, batch_tokens))
+        return batches
+
+    def _embed_batch(self, index, batch, total_batches):
+        texts, tokens = batch
+        for attempt in range(self.max_retries + 1):
+            start = time.perf_counter()
+            try:
+                vectors = self.embeddings.embed_documents(texts)
+            except RETRYABLE_EMBEDDING_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = min(EMBEDDING_BACKOFF_MAX, EMBEDDING_BACKOFF_BASE * 2 ** attempt)
+                delay *= random.uniform(0.5, 1.0)
+                print(f"Embedding batch {index + 1}/{total_batches} failed ({type(e).__name__}), "
+                      f"retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            
+            print(f"Embedded batch {index + 1}/{total_batches}: {len(texts)} chunks, {tokens} tokens "
+                  f"in {time.perf_counter() - start:.2f}s (attempt {attempt + 1})")
+            return vectors
+
+def multipart_boundary(content_type):
+    """Return the boundary parameter of a multipart Content-Type header, or None."""
+    message = Message()
+    message['content-type'] = content_type
+    return message.get_param('boundary')
+
+def parse_multipart(body, boundary):
+    """
+    Yield (headers, payload) for each part of a multipart/form-data body.
+
+    Only the delimiter lines and part headers are scanned and decoded;
+    payload is a memoryview into body, so a file part is never copied.
+    Parts are parsed as they are consumed, so a caller that stops at the
+    part it needs leaves the rest of the body unscanned.
+    """
+    view = memoryview(body)
+    delimiter = b'--' + boundary.encode('latin-1')
+    position = body.find(delimiter)
+    if position < 0:
+        raise ValueError('Multipart boundary not found')
+
+    while True:
+        position += len(delimiter)
+        # The close delimiter ends the body
+        if body[position:position + 2] == b'--':
+            return
+        # Skip transport padding after the delimiter
+        line_end = body.find(b'\r\n', position)
+        if line_end < 0:
+            raise ValueError('Malformed multipart delimiter')
+        position = line_end + 2
+
+        if body[position:position + 2] == b'\r\n':
+            header_end, payload_start = position, position + 2
+        else:
+            header_end = body.find(b'\r\n\r\n', position)
+            if header_end < 0:
+                raise ValueError('Multipart part headers not terminated')
+            payload_start = header_end + 4
+
+        headers = Message()
+        for line in bytes(view[position:header_end]).decode('utf-8', 'replace').split('\r\n'):
+            name, separator, value = line.partition(':')
+            if separator:
+                headers[name.strip()] = value.strip()
+
+        payload_end = body.find(b'\r\n' + delimiter, payload_start)
+        if payload_end < 0:
+            raise ValueError('Multipart part not terminated')
+        yield headers, view[payload_start:payload_end]
+        position = payload_end + 2
+
+def find_file_part(body, boundary, field='file'):
+    """Return (filename, payload) of the named file field of a multipart body, or None."""
+    for headers, payload in parse_multipart(body, boundary):
+        if headers.get_param('name', header='content-disposition') == field:
+            return headers.get_filename(), payload
+    return None
+
+class MemoryviewStream(io.RawIOBase):
+    """A seekable binary stream over a memoryview that reads without copying the buffer."""
+    
+    def __init__(self, view):
+        self._view = view
+        self._position = 0
+    
+    def readable(self):
+        return True
+    
+    def seekable(self):
+        return True
+    
+    def tell(self):
+        return self._position
+    
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = len(self._view) + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        if position < 0:
+            raise ValueError(f"Negative seek position {position}")
+        self._position = position
+        return position
+    
+    def readinto(self, buffer):
+        data = self._view[self._position:self._position + len(buffer)]
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+    
+    def read(self, size=-1):
+        end = len(self._view) if size is None or size < 0 else self._position + size
+        data = bytes(self._view[self._position:end])
+        self._position += len(data)
+        return data
+    
+    readall = read
+
+def load_pdf_pages(pdf_file, source):
+    """Return a Document per page of a PDF, read from a path or a binary stream."""
+    reader = PdfReader(pdf_file)
+    return [
+        Document(page_content=page.extract_text() or '', metadata={'source': source, 'page': number})
+        for number, page in enumerate(reader.pages)
+    ]
+
+def process_pdf(pdf_file, session_id, filename=None):
+    """
+    Process a PDF file and create a vector store. pdf_file is a path or a
+    binary stream, so an upload can be processed straight from memory.
+    """
     # Load PDF
-    loader = PyPDFLoader(pdf_path)
-    documents = loader.load()
+    documents = load_pdf_pages(pdf_file, filename or str(pdf_file))
     
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=1500, 
@@ -101,69 +330,311 @@ def generate_pdf_summary(vectorstore):
 
 def create_vectorstore(chunks, embedding_function, session_id):
     """
-    Create a vector store from a list of text chunks and save to S3.
+    Create a vector store from a list of text chunks and save to S3. The
+    store is also kept in the warm cache, so the first query needs no download.
     """
     # Create a list of unique IDs for each doc based on content
     ids = [str(uuid.uuid5(uuid.NAMESPACE_DNS, doc.page_content)) for doc in chunks]
     
-    unique_ids = set()
+    # IDs stay in chunk order so each one lines up with its chunk
+    unique_ids = []
     unique_chunks = []
+    seen_ids = set()
     
     for chunk, id in zip(chunks, ids):
-        if id not in unique_ids:
-            unique_ids.add(id)
+        if id not in seen_ids:
+            seen_ids.add(id)
+            unique_ids.append(id)
             unique_chunks.append(chunk)
     
-    # Create a vector store using a temporary directory
-    with tempfile.TemporaryDirectory() as tmpdir:
-        persist_dir = os.path.join(tmpdir, "chroma")
-        vectorstore = Chroma.from_documents(
-            documents=unique_chunks, 
-            embedding=embedding_function, 
-            ids=list(unique_ids), 
-            persist_directory=persist_dir
-        )
-        
-        # Save the vectorstore files to S3
-        for root, _, files in os.walk(persist_dir):
-            for file in files:
-                local_path = os.path.join(root, file)
-                s3_path = f"vectorstores/{session_id}/{os.path.relpath(local_path, tmpdir)}"
-                s3_client.upload_file(local_path, S3_BUCKET, s3_path)
+    # Create the vector store in the cache directory
+    tmpdir = new_cache_dir(session_id)
+    vectorstore = None
+    
+    try:
+        if LAMBDA_INDEX_FORMAT == 'packed':
+            # The whole index is one object, written and read with one request
+            vectors = BatchedEmbeddings(embedding_function).embed_documents(
+                [chunk.page_content for chunk in unique_chunks]
+            )
+            path = os.path.join(tmpdir, PACKED_INDEX_FILE)
+            write_packed_index(path, unique_ids, unique_chunks, vectors)
+            upload_files([(path, f"vectorstores/{session_id}/{PACKED_INDEX_FILE}")])
+            
+            vectorstore = PackedVectorStore(embedding_function, path)
+        else:
+            persist_dir = os.path.join(tmpdir, "chroma")
+            vectorstore = Chroma.from_documents(
+                documents=unique_chunks, 
+                embedding=BatchedEmbeddings(embedding_function), 
+                ids=list(unique_ids), 
+                persist_directory=persist_dir
+            )
+            
+            # Save the vectorstore files to S3
+            files = []
+            for root, _, names in os.walk(persist_dir):
+                for name in names:
+                    local_path = os.path.join(root, name)
+                    files.append((local_path, f"vectorstores/{session_id}/{os.path.relpath(local_path, tmpdir)}"))
+            upload_files(files)
         
-        return vectorstore
+        objects = list_session_objects(session_id)
+    except Exception:
+        # Nothing tracks the directory until it is in the cache
+        if vectorstore is not None:
+            close_vectorstore(vectorstore)
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+    
+    session_cache.put(session_id, tmpdir, objects, vectorstore)
+    return vectorstore
 
-def load_vectorstore(session_id):
+def list_session_objects(session_id):
+    """Return {key: (ETag, size)} for a session's vector store files in S3."""
+    prefix = f"vectorstores/{session_id}/"
+    objects = {}
+    for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=S3_BUCKET, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            objects[obj['Key']] = (obj['ETag'], obj['Size'])
+    return objects
+
+def wait_for_transfers(futures):
+    """Wait for every transfer to finish, then raise the first failure if any failed."""
+    errors = []
+    for future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            errors.append(e)
+    if errors:
+        raise errors[0]
+
+def upload_files(files):
+    """Upload (local path, key) pairs to S3 concurrently."""
+    wait_for_transfers([
+        transfer_manager.upload(local_path, S3_BUCKET, key) for local_path, key in files
+    ])
+
+def new_cache_dir(session_id):
     """
-    Load a vector store from S3.
+    Return a new, empty directory in the cache for a session's files. Each
+    download gets its own directory, since Chroma keeps clients open per path.
     """
-    # Download vectorstore files from S3 to a temporary directory
-    with tempfile.TemporaryDirectory() as tmpdir:
-        persist_dir = os.path.join(tmpdir, "chroma")
-        os.makedirs(persist_dir, exist_ok=True)
+    path = os.path.join(LAMBDA_CACHE_DIR, f"{session_id}-{uuid.uuid4().hex}")
+    os.makedirs(path)
+    return path
+
+class SessionCache:
+    """
+    Session vector stores downloaded to /tmp, kept open for later invocations
+    of a warm container. An entry is trusted for revalidate_seconds, then
+    checked against the ETags of the session's S3 objects and downloaded again
+    if any changed. Least recently used entries are removed once the files
+    exceed max_bytes, to stay within Lambda's ephemeral storage.
+    """
+
+    def __init__(self, root, max_bytes, revalidate_seconds):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.revalidate_seconds = revalidate_seconds
+        self._entries = OrderedDict()
         
-        # List objects in the S3 vectorstore directory
-        prefix = f"vectorstores/{session_id}/"
-        response = s3_client.list_objects_v2(Bucket=S3_BUCKET, Prefix=prefix)
+        # Files left by an earlier process have no entry to track them
+        shutil.rmtree(root, ignore_errors=True)
+        os.makedirs(root, exist_ok=True)
+
+    def get(self, session_id):
+        """Return a session's vector store, downloading it only if needed."""
+        entry = self._entries.get(session_id)
+        now = time.time()
+        
+        if entry and now - entry['validated_at'] < self.revalidate_seconds:
+            self._entries.move_to_end(session_id)
+            return entry['vectorstore']
         
-        if 'Contents' not in response:
+        objects = list_session_objects(session_id)
+        if not objects:
+            self.remove(session_id)
             raise ValueError(f"No vectorstore found for session ID: {session_id}")
         
-        # Download each file
-        for obj in response['Contents']:
-            key = obj['Key']
-            local_path = os.path.join(tmpdir, os.path.relpath(key, prefix.rstrip("/")))
-            os.makedirs(os.path.dirname(local_path), exist_ok=True)
-            s3_client.download_file(S3_BUCKET, key, local_path)
+        if entry and entry['objects'] == objects:
+            entry['validated_at'] = now
+            self._entries.move_to_end(session_id)
+            return entry['vectorstore']
+        
+        self.remove(session_id)
+        self._make_room(sum(size for _, size in objects.values()))
+        
+        tmpdir = new_cache_dir(session_id)
+        try:
+            download_session(session_id, objects, tmpdir)
+            vectorstore = open_session_store(tmpdir)
+        except Exception:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            raise
         
-        # Load the vectorstore
-        vectorstore = Chroma(
-            embedding_function=get_embedding_function(OPENAI_API_KEY),
-            persist_directory=persist_dir
-        )
+        return self.put(session_id, tmpdir, objects, vectorstore)
+
+    def put(self, session_id, path, objects, vectorstore):
+        """Add a session whose files are already in path."""
+        if session_id in self._entries and self._entries[session_id]['path'] != path:
+            self.remove(session_id)
         
+        size = sum(size for _, size in objects.values())
+        self._make_room(size, exclude=session_id)
+        self._entries[session_id] = {
+            'path': path,
+            'objects': objects,
+            'size': size,
+            'vectorstore': vectorstore,
+            'validated_at': time.time(),
+        }
+        self._entries.move_to_end(session_id)
         return vectorstore
 
+    def remove(self, session_id):
+        entry = self._entries.pop(session_id, None)
+        if entry:
+            close_vectorstore(entry['vectorstore'])
+            shutil.rmtree(entry['path'], ignore_errors=True)
+
+    def _make_room(self, size, exclude=None):
+        """Remove least recently used sessions, other than exclude, until size more bytes fit."""
+        candidates = [session_id for session_id in self._entries if session_id != exclude]
+        total = sum(self._entries[session_id]['size'] for session_id in candidates)
+        for session_id in candidates:
+            if total + size <= self.max_bytes:
+                break
+            total -= self._entries[session_id]['size']
+            self.remove(session_id)
+
+session_cache = SessionCache(
+    LAMBDA_CACHE_DIR, LAMBDA_CACHE_MAX_MB * 1024 * 1024, LAMBDA_CACHE_REVALIDATE_SECONDS
+)
+
+def download_session(session_id, objects, tmpdir):
+    """Download a session's vector store files into tmpdir, concurrently."""
+    prefix = f"vectorstores/{session_id}"
+    futures = []
+    for key in objects:
+        local_path = os.path.join(tmpdir, os.path.relpath(key, prefix))
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        futures.append(transfer_manager.download(S3_BUCKET, key, local_path))
+    wait_for_transfers(futures)
+
+def open_session_store(tmpdir):
+    """Open a session's downloaded files, a packed index or a Chroma store."""
+    embedding_function = get_embedding_function(OPENAI_API_KEY)
+    if os.path.exists(os.path.join(tmpdir, PACKED_INDEX_FILE)):
+        return PackedVectorStore(embedding_function, os.path.join(tmpdir, PACKED_INDEX_FILE))
+    
+    return Chroma(
+        embedding_function=embedding_function,
+        persist_directory=os.path.join(tmpdir, "chroma")
+    )
+
+def write_packed_index(path, ids, chunks, vectors):
+    """
+    Write a packed index: a fixed preamble (magic, header length, and the
+    offsets of the vector and text blocks), a JSON header with the chunk IDs,
+    metadata and text offsets, the normalized float32 vectors row by row, and
+    the chunk texts as UTF-8. The preamble and header are enough to fetch any
+    vector or text with a ranged GET.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32) if len(ids) else np.zeros((0, 0), dtype=np.float32)
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    texts = [chunk.page_content.encode('utf-8') for chunk in chunks]
+    
+    text_offsets = [0]
+    for text in texts:
+        text_offsets.append(text_offsets[-1] + len(text))
+    
+    header = json.dumps({
+        'version': 1,
+        'count': len(ids),
+        'dim': vectors.shape[1] if len(ids) else 0,
+        'ids': ids,
+        'metadatas': [chunk.metadata for chunk in chunks],
+        'text_offsets': text_offsets,
+    }).encode('utf-8')
+    
+    # Vectors start on a 4-byte boundary so they can be mapped as float32
+    vectors_offset = PACKED_PREAMBLE.size + len(header)
+    vectors_offset += -vectors_offset % 4
+    texts_offset = vectors_offset + vectors.nbytes
+    
+    with open(path, 'wb') as f:
+        f.write(PACKED_PREAMBLE.pack(PACKED_MAGIC, len(header), vectors_offset, texts_offset))
+        f.write(header)
+        f.write(b'\0' * (vectors_offset - PACKED_PREAMBLE.size - len(header)))
+        f.write(vectors.tobytes())
+        for text in texts:
+            f.write(text)
+
+class PackedVectorStore(VectorStore):
+    """
+    A read-only vector store over a packed index file, memory-mapped and
+    searched by brute force, which is all a single PDF's chunks need.
+    """
+
+    def __init__(self, embedding_function, path):
+        self._embedding_function = embedding_function
+        with open(path, 'rb') as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        magic, header_length, vectors_offset, self._texts_offset = PACKED_PREAMBLE.unpack_from(self._data)
+        if magic != PACKED_MAGIC:
+            raise ValueError(f"Not a packed index: {path}")
+        
+        header = json.loads(self._data[PACKED_PREAMBLE.size:PACKED_PREAMBLE.size + header_length])
+        self._ids = header['ids']
+        self._metadatas = header['metadatas']
+        self._text_offsets = header['text_offsets']
+        self._vectors = np.frombuffer(
+            self._data, dtype=np.float32, count=header['count'] * header['dim'], offset=vectors_offset
+        ).reshape(header['count'], header['dim'])
+
+    @property
+    def embeddings(self):
+        return self._embedding_function
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        raise NotImplementedError("Packed indexes are written with write_packed_index")
+
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        raise NotImplementedError("Packed indexes are read-only")
+
+    def _text(self, position):
+        start = self._texts_offset + self._text_offsets[position]
+        end = self._texts_offset + self._text_offsets[position + 1]
+        return self._data[start:end].decode('utf-8')
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        """Return the k chunks closest to an embedding by cosine similarity."""
+        k = min(k, len(self._ids))
+        if k <= 0:
+            return []
+        
+        query = np.asarray(embedding, dtype=np.float32)
+        scores = self._vectors @ (query / (np.linalg.norm(query) or 1.0))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            Document(page_content=self._text(position), metadata=dict(self._metadatas[position]))
+            for position in top
+        ]
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return self.similarity_search_by_vector(self._embedding_function.embed_query(query), k)
+
+def load_vectorstore(session_id):
+    """
+    Load a vector store from S3, or from the warm container's cache.
+    """
+    return session_cache.get(session_id)
+
 def format_docs(docs):
     """Format a list of Document objects into a single string."""
     return "\n\n".join(doc.page_content for doc in docs)
@@ -206,7 +677,12 @@ def query_document(vectorstore, query):
 
 def lambda_handler(event, context):
     """AWS Lambda handler function"""
-    print(f"Received event: {json.dumps(event)}")
+    if str(event.get('path', '')).endswith('/upload'):
+        # The body is the whole file, base64-encoded; logging it would copy it again
+        print(f"Received event: {event.get('httpMethod')} {event.get('path')} "
+              f"headers={json.dumps(event.get('headers'))} body={len(event.get('body') or '')} characters")
+    else:
+        print(f"Received event: {json.dumps(event)}")
     
     # Check if this is an API Gateway request
     if 'httpMethod' not in event:
@@ -238,8 +714,9 @@ def lambda_handler(event, context):
                     'body': json.dumps({'error': 'No file data provided'})
                 }
             
-            # API Gateway sends the file as a base64-encoded string
-            content_type = event.get('headers', {}).get('content-type', '')
+            # Header names are case-insensitive and API Gateway passes them as sent
+            headers = {name.lower(): value for name, value in (event.get('headers') or {}).items()}
+            content_type = headers.get('content-type', '')
             
             if 'multipart/form-data' not in content_type:
                 return {
@@ -247,23 +724,27 @@ def lambda_handler(event, context):
                     'body': json.dumps({'error': 'Content type must be multipart/form-data'})
                 }
             
-            # Parse multipart form data
+            boundary = multipart_boundary(content_type)
+            if not boundary:
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps({'error': 'Multipart boundary not found'})
+                }
+            
+            # API Gateway sends binary bodies base64-encoded
             body = event['body']
             if event.get('isBase64Encoded', False):
                 body = base64.b64decode(body)
+            elif isinstance(body, str):
+                body = body.encode('utf-8')
             
-            # Extract boundary
-            boundary = content_type.split('boundary=')[1].strip()
-            
-            # Parse form data (simplified approach)
-            # In production, use a proper multipart parser
-            parts = body.split(f'--{boundary}'.encode())
-            file_part = None
-            
-            for part in parts:
-                if b'Content-Disposition: form-data; name="file"' in part:
-                    file_part = part
-                    break
+            try:
+                file_part = find_file_part(body, boundary)
+            except ValueError as e:
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps({'error': str(e)})
+                }
             
             if not file_part:
                 return {
@@ -271,65 +752,50 @@ def lambda_handler(event, context):
                     'body': json.dumps({'error': 'No file found in request'})
                 }
             
-            # Extract filename
-            filename_match = file_part.decode().split('\r\n')[1].split('filename="')
-            if len(filename_match) < 2:
+            filename, file_content = file_part
+            if not filename:
                 return {
                     'statusCode': 400,
                     'body': json.dumps({'error': 'Filename not found'})
                 }
             
-            filename = filename_match[1].split('"')[0]
-            
             if not filename.endswith('.pdf'):
                 return {
                     'statusCode': 400,
                     'body': json.dumps({'error': 'File must be a PDF'})
                 }
             
-            # Extract file content
-            file_content_parts = file_part.split(b'\r\n\r\n', 1)
-            if len(file_content_parts) < 2:
+            if not len(file_content):
                 return {
                     'statusCode': 400,
                     'body': json.dumps({'error': 'File content not found'})
                 }
             
-            file_content = file_content_parts[1].split(b'\r\n--', 1)[0]
-            
             # Generate a session ID
             session_id = str(uuid.uuid4())
             
-            # Save the file to S3
+            # Archive the file to S3 while it is processed from memory
             safe_filename = secure_filename(filename)
             s3_path = f"uploads/{session_id}/{safe_filename}"
-            s3_client.put_object(
-                Bucket=S3_BUCKET,
-                Key=s3_path,
-                Body=file_content
-            )
+            archive = transfer_manager.upload(MemoryviewStream(file_content), S3_BUCKET, s3_path)
+            
+            try:
+                # Process the PDF
+                session_id, summary = process_pdf(MemoryviewStream(file_content), session_id, safe_filename)
+            finally:
+                # The container may be frozen once we return, so finish the upload first
+                wait_for_transfers([archive])
+            
+            return {
+                'statusCode': 200,
+                'body': json.dumps({
+                    'success': True,
+                    'session_id': session_id,
+                    'summary': summary,
+                    'message': 'PDF processed successfully'
+                })
+            }
             
-            # Download the file to process it
-            with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as tmp:
-                s3_client.download_file(S3_BUCKET, s3_path, tmp.name)
-                
-                try:
-                    # Process the PDF
-                    session_id, summary = process_pdf(tmp.name, session_id)
-                    
-                    return {
-                        'statusCode': 200,
-                        'body': json.dumps({
-                            'success': True,
-                            'session_id': session_id,
-                            'summary': summary,
-                            'message': 'PDF processed successfully'
-                        })
-                    }
-                finally:
-                    # Clean up
-                    os.unlink(tmp.name)
-                    
         except Exception as e:
             print(f"Error processing PDF: {str(e)}")
             return {
@@ -0,0 +1,99 @@
+"""
+Import the per-index vector stores under VECTOR_STORE_DIR, Chroma or NumPy,
+into the shared collection used when VECTOR_STORE_MODE=shared.
+
+Stored embeddings are copied as they are, so nothing is re-embedded.
+Quantized NumPy indexes are imported with their exact vectors from the
+embedding cache, and skipped if the cache does not hold them all. Each
+index directory is kept for its summary, document list, extracted metadata
+and BM25 index; pass --remove to delete its vector store files once they
+have been imported.
+
+Usage:
+    python migrate_to_shared.py [--remove]
+"""
+import argparse
+import os
+import shutil
+
+from langchain_community.vectorstores import Chroma
+
+from api import (
+    BM25_FILE, DOCUMENTS_FILE, METADATA_FILE, SUMMARY_FILE, VECTOR_STORE_DIR,
+    SharedIndex, get_shared_store, is_numpy_index, load_vectorstore,
+)
+from chroma_clients import close_vectorstore
+
+def index_dirs():
+    """Yield (index name, path) for every per-index vector store directory."""
+    for name in sorted(os.listdir(VECTOR_STORE_DIR)):
+        path = os.path.join(VECTOR_STORE_DIR, name)
+        # Anything that is not an index is prefixed with '_'
+        if name.startswith('_') or not os.path.isdir(path):
+            continue
+        if is_numpy_index(path) or os.path.exists(os.path.join(path, 'chroma.sqlite3')):
+            yield name, path
+
+def read_index(path):
+    """
+    Return an index's ids, exact embeddings, metadatas and documents, or None
+    if a quantized index's exact vectors are not all in the embedding cache.
+    """
+    if not is_numpy_index(path):
+        vectorstore = Chroma(persist_directory=path)
+        try:
+            data = vectorstore.get(include=['embeddings', 'metadatas', 'documents'])
+        finally:
+            # Each Chroma directory would otherwise keep its SQLite connection and HNSW index open
+            close_vectorstore(vectorstore)
+        return data['ids'], data['embeddings'], data['metadatas'], data['documents']
+    
+    vectorstore = load_vectorstore(path)
+    if vectorstore.quantization == 'none':
+        data = vectorstore.get(include=['embeddings', 'metadatas', 'documents'])
+        return data['ids'], data['embeddings'], data['metadatas'], data['documents']
+    
+    # Stored vectors are approximations; the shared collection gets exact ones
+    data = vectorstore.get(include=['metadatas', 'documents'])
+    embeddings = vectorstore.embeddings.cached_vectors(data['documents'])
+    if any(vector is None for vector in embeddings):
+        return None
+    return data['ids'], embeddings, data['metadatas'], data['documents']
+
+def remove_store_files(path):
+    """Delete an index directory's vector store files, keeping the files the API reads directly."""
+    for name in os.listdir(path):
+        entry = os.path.join(path, name)
+        if name in (SUMMARY_FILE, DOCUMENTS_FILE, BM25_FILE, METADATA_FILE):
+            continue
+        if os.path.isdir(entry):
+            shutil.rmtree(entry)
+        else:
+            os.remove(entry)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--remove', action='store_true', help='delete vector store files once imported')
+    args = parser.parse_args()
+
+    store = get_shared_store()
+    migrated = 0
+
+    for index_name, path in index_dirs():
+        data = read_index(path)
+        if data is None:
+            print(f"Skipped {index_name}: quantized, and its exact vectors are not all in the embedding cache")
+            continue
+        
+        ids, embeddings, metadatas, documents = data
+        SharedIndex(store, index_name).add_embeddings(ids, embeddings, metadatas, documents)
+        print(f"Imported {len(ids)} chunks from {index_name}")
+
+        if args.remove:
+            remove_store_files(path)
+        migrated += 1
+
+    print(f"Migrated {migrated} indexes into the shared collection")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,11 @@
+"""
+Page text extraction run in the API's worker processes. It is kept apart from
+api.py so that the workers, started from a fork server, import only pypdf
+rather than the whole app.
+"""
+from pypdf import PdfReader
+
+def extract_page_texts(pdf_path, start, end):
+    """Extract the text of pages start to end - 1 of a PDF. Runs in a worker process."""
+    reader = PdfReader(pdf_path)
+    return [reader.pages[i].extract_text() for i in range(start, end)]
@@ -0,0 +1,116 @@
+"""
+Report how closely quantized vector search matches exact search on the
+sessions under VECTOR_STORE_DIR, to choose a VECTOR_QUANTIZATION setting.
+
+Each index's chunk embeddings serve as queries against the same index, with
+the query chunk itself left out. recall@k is the share of the exact top k
+that a quantized search also returns, without and with re-scoring
+rerank-factor * k candidates exactly. Indexes that are already quantized are
+measured against exact vectors from the embedding cache, and skipped if the
+cache does not hold them all.
+
+Usage:
+    python quantization_recall.py [--k 4] [--queries 50] [session_id ...]
+"""
+import argparse
+import os
+
+import numpy as np
+
+from api import (
+    NUMPY_RERANK_FACTOR, VECTOR_STORE_DIR,
+    NumpyVectorStore, dequantize, is_numpy_index, load_vectorstore, quantize, session_index_dir,
+)
+
+QUANTIZATIONS = ['float16', 'int8']
+
+def exact_vectors(index_dir):
+    """Return an index's normalized float32 embeddings, or None if they are not available."""
+    vectorstore = load_vectorstore(index_dir)
+    if isinstance(vectorstore, NumpyVectorStore) and vectorstore.quantization != 'none':
+        texts = vectorstore.get(include=['documents'])['documents']
+        vectors = vectorstore.embeddings.cached_vectors(texts)
+        if any(vector is None for vector in vectors):
+            return None
+    else:
+        vectors = vectorstore.get(include=['embeddings'])['embeddings']
+
+    if vectors is None or not len(vectors):
+        return None
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def top_k(scores, k):
+    """Return the positions of the k highest scores."""
+    k = min(k, len(scores))
+    return np.argpartition(-scores, k - 1)[:k]
+
+def measure(vectors, quantization, queries, k, rerank_factor):
+    """Return (recall@k, recall@k with re-scoring) of a quantization over the query rows."""
+    approximate = dequantize(*quantize(vectors, quantization))
+    hits = reranked_hits = total = 0
+
+    for query in queries:
+        exact_scores = vectors @ vectors[query]
+        approximate_scores = approximate @ vectors[query]
+        # The query chunk would always be its own best match
+        exact_scores[query] = approximate_scores[query] = -np.inf
+
+        expected = set(top_k(exact_scores, k))
+        candidates = top_k(approximate_scores, k * rerank_factor)
+        reranked = candidates[np.argsort(-exact_scores[candidates])[:k]]
+
+        hits += len(expected & set(top_k(approximate_scores, k)))
+        reranked_hits += len(expected & set(reranked))
+        total += len(expected)
+
+    return hits / total, reranked_hits / total
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('session_ids', nargs='*', help='sessions to measure (default: every index)')
+    parser.add_argument('--k', type=int, default=4, help='number of chunks retrieved per question')
+    parser.add_argument('--queries', type=int, default=50, help='query chunks sampled per index')
+    parser.add_argument('--rerank-factor', type=int, default=NUMPY_RERANK_FACTOR)
+    args = parser.parse_args()
+
+    if args.session_ids:
+        index_dirs = [session_index_dir(session_id) for session_id in args.session_ids]
+    else:
+        index_dirs = [
+            os.path.join(VECTOR_STORE_DIR, name) for name in sorted(os.listdir(VECTOR_STORE_DIR))
+            if not name.startswith('_') and (
+                is_numpy_index(os.path.join(VECTOR_STORE_DIR, name))
+                or os.path.exists(os.path.join(VECTOR_STORE_DIR, name, 'chroma.sqlite3'))
+            )
+        ]
+
+    rng = np.random.default_rng(0)
+    totals = {quantization: [0.0, 0.0, 0] for quantization in QUANTIZATIONS}
+
+    print(f"{'index':<38} {'chunks':>6} {'quantization':>12} {'recall@k':>9} {'reranked':>9} {'bytes/vec':>9}")
+    for index_dir in index_dirs:
+        vectors = exact_vectors(index_dir)
+        if vectors is None or len(vectors) <= args.k:
+            print(f"{os.path.basename(index_dir):<38} skipped: exact vectors not available or too few chunks")
+            continue
+
+        queries = rng.choice(len(vectors), size=min(args.queries, len(vectors)), replace=False)
+        for quantization in QUANTIZATIONS:
+            recall, reranked = measure(vectors, quantization, queries, args.k, args.rerank_factor)
+            matrix, scales = quantize(vectors, quantization)
+            bytes_per_vector = matrix.itemsize * matrix.shape[1] + (scales.itemsize if scales is not None else 0)
+            print(f"{os.path.basename(index_dir):<38} {len(vectors):>6} {quantization:>12} "
+                  f"{recall:>9.4f} {reranked:>9.4f} {bytes_per_vector:>9}")
+
+            totals[quantization][0] += recall * len(queries)
+            totals[quantization][1] += reranked * len(queries)
+            totals[quantization][2] += len(queries)
+
+    for quantization, (recall, reranked, count) in totals.items():
+        if count:
+            print(f"Overall {quantization}: recall@{args.k} {recall / count:.4f}, "
+                  f"with re-scoring {reranked / count:.4f} over {count} queries")
+
+if __name__ == '__main__':
+    main()